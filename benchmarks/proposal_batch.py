@@ -0,0 +1,107 @@
+"""
+Mask R-CNN
+Benchmarks the graph construction time, graph size and throughput of the
+ProposalLayer as IMAGES_PER_GPU grows, for each RPN_NMS_MODE.
+
+Inputs are random RPN scores and deltas over the anchors of IMAGE_SHAPE,
+so no weights or dataset are needed.
+
+Usage:
+    python benchmarks/proposal_batch.py --batch-sizes 1 2 4 8 16
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(ROOT_DIR)
+from mrcnn.config import Config  # noqa: E402
+from mrcnn import model as modellib  # noqa: E402
+
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    GPU_COUNT = 1
+    NUM_CLASSES = 2
+    IMAGE_MIN_DIM = 512
+    IMAGE_MAX_DIM = 512
+
+
+def random_rpn_outputs(batch_size, anchor_count, random_state):
+    """Returns random [batch, anchors, 2] probabilities and
+    [batch, anchors, 4] deltas, shaped like the RPN outputs.
+    """
+    logits = random_state.normal(0, 2, (batch_size, anchor_count))
+    fg = 1 / (1 + np.exp(-logits))
+    probs = np.stack([1 - fg, fg], axis=-1).astype(np.float32)
+    deltas = random_state.normal(0, 1, (batch_size, anchor_count, 4))
+    return probs, deltas.astype(np.float32)
+
+
+def benchmark(config, mode, runs):
+    """Builds the ProposalLayer of one batch size and NMS mode in a new
+    graph and times it.
+
+    Returns: (build seconds, graph op count, images per second)
+    """
+    config.RPN_NMS_MODE = mode
+    anchors = modellib.pyramid_anchors(config, config.IMAGE_SHAPE,
+                                       normalized=True)
+    anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
+    probs, deltas = random_rpn_outputs(config.BATCH_SIZE, anchors.shape[1],
+                                       np.random.RandomState(0))
+
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = [tf.placeholder(tf.float32, [config.BATCH_SIZE, None, n])
+                  for n in [2, 4, 4]]
+        start = time.time()
+        proposals = modellib.ProposalLayer(
+            proposal_count=config.POST_NMS_ROIS_INFERENCE,
+            nms_threshold=config.RPN_NMS_THRESHOLD,
+            pre_nms_limit=config.PRE_NMS_LIMIT_INFERENCE,
+            config=config)(inputs)
+        build_time = time.time() - start
+        op_count = len(graph.get_operations())
+
+        feed = dict(zip(inputs, [probs, deltas, anchors]))
+        with tf.Session(graph=graph) as sess:
+            # Warm up
+            sess.run(proposals, feed)
+            start = time.time()
+            for _ in range(runs):
+                sess.run(proposals, feed)
+            run_time = time.time() - start
+    return build_time, op_count, runs * config.BATCH_SIZE / run_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ProposalLayer against the batch size.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16])
+    parser.add_argument('--modes', nargs='+',
+                        default=["per_image", "combined"],
+                        help="RPN_NMS_MODE values to compare")
+    parser.add_argument('--image-size', type=int, default=512,
+                        help="IMAGE_MAX_DIM. A multiple of 64.")
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    print("{:>10} {:>6} {:>10} {:>8} {:>10}".format(
+        "mode", "batch", "build (s)", "ops", "images/s"))
+    for mode in args.modes:
+        for batch_size in args.batch_sizes:
+            class RunConfig(BenchmarkConfig):
+                IMAGES_PER_GPU = batch_size
+                IMAGE_MIN_DIM = args.image_size
+                IMAGE_MAX_DIM = args.image_size
+            build_time, op_count, throughput = benchmark(
+                RunConfig(), mode, args.runs)
+            print("{:>10} {:>6} {:>10.3f} {:>8} {:>10.1f}".format(
+                mode, batch_size, build_time, op_count, throughput))
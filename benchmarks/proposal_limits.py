@@ -0,0 +1,181 @@
+"""
+Mask R-CNN
+Benchmarks the proposal stage time and recall at several pre-NMS limits,
+to choose PRE_NMS_LIMIT_INFERENCE, PRE_NMS_LIMIT_TRAINING and
+PRE_NMS_LIMIT_PER_LEVEL.
+
+Runs the ProposalLayer on a synthetic dataset. Each image has random GT
+boxes, and the RPN outputs are simulated from them: anchors that overlap
+a GT box more get higher scores and deltas towards the box, plus noise.
+Recall is the fraction of GT boxes matched by a proposal at the given
+IoU. The noise levels set how good the simulated RPN is, so compare the
+limits with each other rather than with trained models.
+
+Usage:
+    python benchmarks/proposal_limits.py --limits 500 1000 2000 6000
+    python benchmarks/proposal_limits.py --limits 200 500 1000 --per-level
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(ROOT_DIR)
+from mrcnn.config import Config  # noqa: E402
+from mrcnn import model as modellib  # noqa: E402
+from mrcnn import utils  # noqa: E402
+
+
+class BenchmarkConfig(Config):
+    NAME = "benchmark"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+    NUM_CLASSES = 2
+    IMAGE_MIN_DIM = 1024
+    IMAGE_MAX_DIM = 1024
+
+
+def synthetic_dataset(config, count, max_gt, random_state):
+    """Generates random GT boxes in pixels for count images of size
+    IMAGE_SHAPE. Box sides are log-uniform from 16 pixels to half the image.
+
+    Returns: list of [instances, (y1, x1, y2, x2)] arrays.
+    """
+    size = config.IMAGE_SHAPE[0]
+    images = []
+    for _ in range(count):
+        n = random_state.randint(1, max_gt + 1)
+        hw = np.exp(random_state.uniform(np.log(16), np.log(size / 2), (n, 2)))
+        y1x1 = random_state.uniform(0, size - hw)
+        images.append(np.round(np.concatenate([y1x1, y1x1 + hw], axis=1)))
+    return images
+
+
+def simulate_rpn(config, anchors, gt_boxes, score_noise, delta_noise,
+                 random_state):
+    """Simulates the RPN outputs of an image from its GT boxes.
+
+    anchors: [anchors, (y1, x1, y2, x2)] in pixels.
+
+    Returns:
+    probs: [anchors, (bg prob, fg prob)]
+    deltas: [anchors, (dy, dx, log(dh), log(dw))] divided by RPN_BBOX_STD_DEV,
+        like the rpn_bbox output.
+    """
+    iou_max, iou_argmax, _ = utils.compute_overlaps_argmax(anchors, gt_boxes)
+    logits = 10 * (iou_max - 0.4) + random_state.normal(
+        0, score_noise, iou_max.shape)
+    fg = 1 / (1 + np.exp(-logits))
+    probs = np.stack([1 - fg, fg], axis=-1)
+    # Deltas towards the closest GT box for overlapping anchors only
+    deltas = utils.box_refinement(anchors, gt_boxes[iou_argmax]) / \
+        config.RPN_BBOX_STD_DEV
+    deltas[iou_max < 0.3] = 0
+    deltas += random_state.normal(0, delta_noise, deltas.shape)
+    return probs.astype(np.float32), deltas.astype(np.float32)
+
+
+def level_anchor_counts(config):
+    """Returns the number of anchors of each FPN level of IMAGE_SHAPE."""
+    backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+    return [utils.generate_anchors(
+        config.RPN_ANCHOR_SCALES[i], config.RPN_ANCHOR_RATIOS,
+        backbone_shapes[i], config.BACKBONE_STRIDES[i],
+        config.RPN_ANCHOR_STRIDE).shape[0]
+        for i in range(len(backbone_shapes))]
+
+
+def benchmark(config, limit, per_level, samples, iou_thresholds):
+    """Runs the ProposalLayer with one pre-NMS limit over the samples.
+
+    samples: list of (gt_boxes, probs, deltas) tuples.
+
+    Returns: (milliseconds per image, list of recalls at iou_thresholds)
+    """
+    anchors = modellib.pyramid_anchors(config, config.IMAGE_SHAPE,
+                                       normalized=True)
+    graph = tf.Graph()
+    with graph.as_default():
+        input_probs = tf.placeholder(tf.float32, [1, None, 2])
+        input_deltas = tf.placeholder(tf.float32, [1, None, 4])
+        inputs = [input_probs, input_deltas, tf.constant(anchors[np.newaxis])]
+        if per_level:
+            # Only the level shapes are used, to split the anchors
+            inputs += [tf.zeros([1, n, 2]) for n in level_anchor_counts(config)]
+        proposals = modellib.ProposalLayer(
+            proposal_count=config.POST_NMS_ROIS_INFERENCE,
+            nms_threshold=config.RPN_NMS_THRESHOLD,
+            pre_nms_limit=limit, config=config)(inputs)
+
+        elapsed = 0
+        matched = np.zeros([len(iou_thresholds)])
+        gt_count = 0
+        with tf.Session(graph=graph) as sess:
+            # Warm up
+            sess.run(proposals, {input_probs: samples[0][1][np.newaxis],
+                                 input_deltas: samples[0][2][np.newaxis]})
+            for gt_boxes, probs, deltas in samples:
+                start = time.time()
+                rois = sess.run(proposals, {input_probs: probs[np.newaxis],
+                                            input_deltas: deltas[np.newaxis]})
+                elapsed += time.time() - start
+                rois = utils.denorm_boxes(utils.trim_zeros(rois[0]),
+                                          config.IMAGE_SHAPE[:2])
+                if rois.shape[0]:
+                    best = utils.compute_overlaps(gt_boxes, rois).max(axis=1)
+                else:
+                    best = np.zeros([gt_boxes.shape[0]])
+                matched += [np.sum(best >= t) for t in iou_thresholds]
+                gt_count += gt_boxes.shape[0]
+    return 1000 * elapsed / len(samples), list(matched / gt_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark proposal time and recall against the pre-NMS limit.')
+    parser.add_argument('--limits', type=int, nargs='+',
+                        default=[500, 1000, 2000, 4000, 6000])
+    parser.add_argument('--per-level', action='store_true',
+                        help="Apply the limits to each FPN level")
+    parser.add_argument('--images', type=int, default=50)
+    parser.add_argument('--max-gt', type=int, default=50,
+                        help="Max GT boxes per image")
+    parser.add_argument('--image-size', type=int, default=1024,
+                        help="IMAGE_MAX_DIM. A multiple of 64.")
+    parser.add_argument('--score-noise', type=float, default=2.0,
+                        help="Std of the noise added to the RPN logits")
+    parser.add_argument('--delta-noise', type=float, default=0.5,
+                        help="Std of the noise added to the RPN deltas")
+    parser.add_argument('--iou', type=float, nargs='+', default=[0.5, 0.7],
+                        help="IoU thresholds of the recall")
+    args = parser.parse_args()
+
+    class RunConfig(BenchmarkConfig):
+        IMAGE_MIN_DIM = args.image_size
+        IMAGE_MAX_DIM = args.image_size
+        PRE_NMS_LIMIT_PER_LEVEL = args.per_level
+    config = RunConfig()
+
+    random_state = np.random.RandomState(0)
+    anchors = modellib.pyramid_anchors(config, config.IMAGE_SHAPE)
+    samples = []
+    for gt_boxes in synthetic_dataset(config, args.images, args.max_gt,
+                                      random_state):
+        probs, deltas = simulate_rpn(config, anchors, gt_boxes,
+                                     args.score_noise, args.delta_noise,
+                                     random_state)
+        samples.append((gt_boxes, probs, deltas))
+
+    print("{} anchors, {} images, per-level: {}".format(
+        anchors.shape[0], args.images, args.per_level))
+    print("{:>8} {:>10} ".format("limit", "ms/image") +
+          " ".join("{:>12}".format("recall@{}".format(t)) for t in args.iou))
+    for limit in args.limits:
+        ms, recalls = benchmark(config, limit, args.per_level, samples, args.iou)
+        print("{:>8} {:>10.2f} ".format(limit, ms) +
+              " ".join("{:>12.3f}".format(r) for r in recalls))
@@ -0,0 +1,98 @@
+"""
+Mask R-CNN
+Benchmarks the graph construction time and throughput of PyramidROIAlign
+as the batch size grows, for the pool shapes of the classifier and mask
+heads.
+
+Inputs are random feature maps and boxes, so no weights or dataset are
+needed.
+
+Usage:
+    python benchmarks/roi_align_batch.py --batch-sizes 1 2 4 8 --rois 200
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Root directory of the project
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(ROOT_DIR)
+from mrcnn import model as modellib  # noqa: E402
+
+
+def random_inputs(batch_size, rois, image_size, channels, random_state):
+    """Returns random ROI Align inputs for a batch of square images.
+
+    Returns:
+    boxes: [batch, rois, (y1, x1, y2, x2)] in normalized coordinates. Box
+        sides are log-uniform from 8 pixels to the image size, so all
+        pyramid levels get boxes.
+    image_meta: [batch, meta length]
+    feature_maps: [P2, P3, P4, P5] of [batch, height, width, channels]
+    """
+    hw = np.exp(random_state.uniform(np.log(8), np.log(image_size),
+                                     (batch_size, rois, 2)))
+    y1x1 = random_state.uniform(0, image_size - hw)
+    boxes = np.concatenate([y1x1, y1x1 + hw], axis=2) / image_size
+    shape = (image_size, image_size, 3)
+    image_meta = np.stack([modellib.compose_image_meta(
+        i, shape, shape, (0, 0, image_size, image_size), 1,
+        np.ones([2], np.int32)) for i in range(batch_size)])
+    feature_maps = [random_state.rand(batch_size, image_size // s,
+                                      image_size // s, channels)
+                    for s in [4, 8, 16, 32]]
+    return ([boxes.astype(np.float32), image_meta.astype(np.float32)] +
+            [f.astype(np.float32) for f in feature_maps])
+
+
+def benchmark(pool_shape, arrays, runs):
+    """Builds a PyramidROIAlign in a new graph and times it.
+
+    Returns: (build seconds, ROIs per second)
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        inputs = [tf.placeholder(tf.float32, a.shape) for a in arrays]
+        start = time.time()
+        pooled = modellib.PyramidROIAlign(pool_shape)(inputs)
+        build_time = time.time() - start
+
+        feed = dict(zip(inputs, arrays))
+        with tf.Session(graph=graph) as sess:
+            # Warm up
+            sess.run(pooled, feed)
+            start = time.time()
+            for _ in range(runs):
+                sess.run(pooled, feed)
+            run_time = time.time() - start
+    rois = arrays[0].shape[0] * arrays[0].shape[1]
+    return build_time, runs * rois / run_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark PyramidROIAlign against the batch size.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--rois', type=int, default=200,
+                        help="ROIs per image")
+    parser.add_argument('--image-size', type=int, default=512)
+    parser.add_argument('--channels', type=int, default=256)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    pool_shapes = {"7x7": [7, 7], "14x14": [14, 14],
+                   "7x7+14x14": [[7, 7], [14, 14]]}
+    print("{:>10} {:>6} {:>10} {:>10}".format(
+        "pool", "batch", "build (s)", "ROIs/s"))
+    for name, pool_shape in pool_shapes.items():
+        for batch_size in args.batch_sizes:
+            arrays = random_inputs(batch_size, args.rois, args.image_size,
+                                   args.channels, np.random.RandomState(0))
+            build_time, throughput = benchmark(pool_shape, arrays, args.runs)
+            print("{:>10} {:>6} {:>10.3f} {:>10.0f}".format(
+                name, batch_size, build_time, throughput))
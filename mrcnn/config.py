@@ -89,9 +89,36 @@ class Config(object):
     # You can increase this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
 
+    # How the RPN proposals of a batch are suppressed.
+    # per_image: tf.image.non_max_suppression on each image, run with
+    #            tf.map_fn. Works on any device.
+    # combined:  tf.image.combined_non_max_suppression on the whole batch
+    #            in one op. Needs TF 1.14+ and only has a CPU kernel, so on
+    #            GPU the boxes are copied to the host. Benchmark with
+    #            benchmarks/proposal_batch.py before switching.
+    RPN_NMS_MODE = "per_image"
+
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
 
+    # How anchors are matched to GT boxes when building RPN training targets.
+    # dense:   Compute the IoU of every anchor with every GT box.
+    # indexed: Use a spatial index over the anchor pyramid and only score
+    #          the anchors that intersect a GT box. Gives the same targets,
+    #          but the cost scales with object area rather than anchor count.
+    #          Faster on images with many GT boxes.
+    RPN_ANCHOR_MATCHING = "dense"
+
+    # ROIs kept after tf.nn.top_k and before non-maximum suppression.
+    # Lower values make the proposal stage faster at some cost in recall.
+    # benchmarks/proposal_limits.py measures the trade-off.
+    PRE_NMS_LIMIT_TRAINING = 6000
+    PRE_NMS_LIMIT_INFERENCE = 6000
+
+    # If True, the pre-NMS limit applies to each FPN level separately (as
+    # in Detectron) rather than to the anchors of all levels together.
+    PRE_NMS_LIMIT_PER_LEVEL = False
+
     # ROIs kept after non-maximum supression (training and inference)
     POST_NMS_ROIS_TRAINING = 2000
     POST_NMS_ROIS_INFERENCE = 1000
@@ -121,6 +148,12 @@ class Config(object):
     #         on IMAGE_MIN_DIM and IMAGE_MIN_SCALE, then picks a random crop of
     #         size IMAGE_MIN_DIM x IMAGE_MIN_DIM. Can be used in training only.
     #         IMAGE_MAX_DIM is not used in this mode.
+    # pad64_batch: Scales like square, but pads each batch only to the
+    #         smallest multiple-of-64 shape that holds all its images, rather
+    #         than to [max_dim, max_dim]. In training, DataSequence groups
+    #         images of similar aspect ratio into batches to keep the padding
+    #         small. Needs "height" and "width" in the dataset's image info,
+    #         otherwise images are loaded once to read their size.
     IMAGE_RESIZE_MODE = "square"
     IMAGE_MIN_DIM = 800
     IMAGE_MAX_DIM = 1024
@@ -130,6 +163,16 @@ class Config(object):
     # Howver, in 'square' mode, it can be overruled by IMAGE_MAX_DIM.
     IMAGE_MIN_SCALE = 0
 
+    # Directory to cache the resized training images and masks in. The
+    # samples are prepared once and memory mapped in later epochs and runs.
+    # Not used for training data when augmentation is enabled, and not
+    # supported in "crop" and "pad64_batch" modes. See SampleCache in model.py.
+    SAMPLE_CACHE_DIR = None
+    # If True, the sample cache also stores the positive and negative anchor
+    # candidates of each image, so that only the random subsampling of the
+    # RPN targets is done per epoch. Needs images of size IMAGE_SHAPE.
+    CACHE_RPN_TARGETS = False
+
     # Image mean (RGB)
     MEAN_PIXEL = np.array([123.7, 116.8, 103.9])
 
@@ -168,6 +211,29 @@ class Config(object):
     # Non-maximum suppression threshold for detection
     DETECTION_NMS_THRESHOLD = 0.3
 
+    # How overlapping detections are suppressed.
+    # per_class: Hard NMS run separately for each class (the original
+    #            behavior). Runs one NMS op per class present in the image.
+    # batched:   Hard NMS run once on all classes by offsetting the boxes
+    #            of each class so boxes of different classes never overlap.
+    #            Approximately the same results as per_class in a single op.
+    #            The offset costs float32 precision, so boxes with an IoU
+    #            right at DETECTION_NMS_THRESHOLD may be kept or dropped
+    #            differently.
+    # soft:      Gaussian Soft-NMS in a single op. Decays the scores of
+    #            overlapping boxes rather than dropping them. Needs TF 1.15+.
+    # matrix:    Matrix NMS (SOLOv2). Decays all scores at once from the
+    #            IoU matrix, with no sequential loop.
+    DETECTION_NMS_MODE = "per_class"
+
+    # Score decay settings for the soft and matrix modes. Detections with
+    # decayed scores below DETECTION_NMS_MIN_SCORE are dropped.
+    # Matrix NMS kernel is "gaussian" or "linear".
+    DETECTION_NMS_MIN_SCORE = 0.05
+    DETECTION_SOFT_NMS_SIGMA = 0.5
+    DETECTION_MATRIX_NMS_KERNEL = "gaussian"
+    DETECTION_MATRIX_NMS_SIGMA = 2.0
+
     # Learning rate and momentum
     # The Mask RCNN paper uses lr=0.02, but on TensorFlow it causes
     # weights to explode. Likely due to differences in optimzer
@@ -10,10 +10,15 @@ Written by Waleed Abdulla
 import os
 import random
 import datetime
+import hashlib
+import itertools
 import re
 import math
 import logging
-from collections import OrderedDict
+import threading
+import traceback
+from collections import OrderedDict, deque
+import concurrent.futures
 import multiprocessing
 import numpy as np
 import skimage.transform
@@ -212,46 +217,62 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., N, (y1, x1, y2, x2)] boxes to update
+    deltas: [..., N, (dy, dx, log(dh), log(dw))] refinements to apply
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, (y1, x1, y2, x2)]
+    boxes: [..., N, (y1, x1, y2, x2)]
     window: [4] in the form y1, x1, y2, x2
     """
     # Split
     wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
-    clipped.set_shape((clipped.shape[0], 4))
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
+    clipped.set_shape(clipped.shape[:-1].concatenate([4]))
     return clipped
 
 
+def batch_gather_graph(params, indices, name=None):
+    """Gathers along the second axis of params, separately for each item
+    of the batch. A batched tf.gather that avoids unrolling the batch with
+    utils.batch_slice.
+
+    params: [batch, N, ...]
+    indices: [batch, K] int32 indices into the N axis.
+
+    Returns: [batch, K, ...]
+    """
+    batch_ix = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                       [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([batch_ix, indices], axis=-1),
+                        name=name)
+
+
 class ProposalLayer(KE.Layer):
     """Receives anchor scores and selects a subset to pass as proposals
     to the second stage. Filtering is done based on anchor scores and
@@ -261,17 +282,22 @@ class ProposalLayer(KE.Layer):
     Inputs:
         rpn_probs: [batch, anchors, (bg prob, fg prob)]
         rpn_bbox: [batch, anchors, (dy, dx, log(dh), log(dw))]
-        anchors: [batch, (y1, x1, y2, x2)] anchors in normalized coordinates
+        anchors: [batch, anchors, (y1, x1, y2, x2)] anchors in normalized coordinates
+        level_probs: Optional. The rpn_probs of each FPN level, in the order
+            the levels are concatenated in rpn_probs. If given, the top
+            pre_nms_limit anchors are taken from each level.
 
     Returns:
         Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
     """
 
-    def __init__(self, proposal_count, nms_threshold, config=None, **kwargs):
+    def __init__(self, proposal_count, nms_threshold, pre_nms_limit=6000,
+                 config=None, **kwargs):
         super(ProposalLayer, self).__init__(**kwargs)
         self.config = config
         self.proposal_count = proposal_count
         self.nms_threshold = nms_threshold
+        self.pre_nms_limit = pre_nms_limit
 
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
@@ -284,48 +310,72 @@ class ProposalLayer(KE.Layer):
 
         # Improve performance by trimming to top anchors by score
         # and doing the rest on the smaller subset.
-        pre_nms_limit = tf.minimum(6000, tf.shape(anchors)[1])
-        ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
-                         name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
+        if len(inputs) > 3:
+            # Top anchors of each level. Levels are contiguous in scores.
+            ix = []
+            offset = 0
+            for level_probs in inputs[3:]:
+                level_count = tf.shape(level_probs)[1]
+                level_limit = tf.minimum(self.pre_nms_limit, level_count)
+                level_ix = tf.nn.top_k(scores[:, offset:offset + level_count],
+                                       level_limit, sorted=True).indices
+                ix.append(level_ix + offset)
+                offset += level_count
+            ix = tf.concat(ix, axis=1, name="top_anchors")
+        else:
+            pre_nms_limit = tf.minimum(self.pre_nms_limit, tf.shape(anchors)[1])
+            ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
+                             name="top_anchors").indices
+        scores = batch_gather_graph(scores, ix)
+        deltas = batch_gather_graph(deltas, ix)
+        pre_nms_anchors = batch_gather_graph(anchors, ix,
+                                             name="pre_nms_anchors")
 
         # Apply deltas to anchors to get refined anchors.
         # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
+        boxes = apply_box_deltas_graph(pre_nms_anchors, deltas)
 
         # Clip to image boundaries. Since we're in normalized coordinates,
         # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        boxes = clip_boxes_graph(boxes, window)
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
         # for small objects, so we're skipping it.
 
         # Non-max suppression
-        def nms(boxes, scores):
-            indices = tf.image.non_max_suppression(
-                boxes, scores, self.proposal_count,
-                self.nms_threshold, name="rpn_non_max_suppression")
-            proposals = tf.gather(boxes, indices)
-            # Pad if needed
-            padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
-            proposals = tf.pad(proposals, [(0, padding), (0, 0)])
-            return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        mode = self.config.RPN_NMS_MODE
+        if mode == "combined":
+            if not hasattr(tf.image, "combined_non_max_suppression"):
+                raise Exception("Combined NMS requires TensorFlow 1.14 or newer")
+            # One op for the whole batch. Treat the boxes as a single
+            # class, and keep the thresholds and unclipped boxes of the
+            # per_image mode. Results are zero padded to proposal_count.
+            proposals = tf.image.combined_non_max_suppression(
+                tf.expand_dims(boxes, 2), tf.expand_dims(scores, 2),
+                max_output_size_per_class=self.proposal_count,
+                max_total_size=self.proposal_count,
+                iou_threshold=self.nms_threshold,
+                score_threshold=float("-inf"),
+                clip_boxes=False,
+                name="rpn_non_max_suppression").nmsed_boxes
+        elif mode == "per_image":
+            def nms(inputs):
+                boxes, scores = inputs
+                indices = tf.image.non_max_suppression(
+                    boxes, scores, self.proposal_count,
+                    self.nms_threshold, name="rpn_non_max_suppression")
+                proposals = tf.gather(boxes, indices)
+                # Pad if needed
+                padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
+                proposals = tf.pad(proposals, [(0, padding), (0, 0)])
+                proposals.set_shape([self.proposal_count, 4])
+                return proposals
+            # map_fn builds the NMS op once regardless of the batch size
+            proposals = tf.map_fn(nms, (boxes, scores), dtype=tf.float32)
+        else:
+            raise Exception("Unknown RPN_NMS_MODE: {}".format(mode))
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -346,24 +396,33 @@ class PyramidROIAlign(KE.Layer):
 
     Params:
     - pool_shape: [height, width] of the output pooled regions. Usually [7, 7]
+                  Or a list of such shapes to pool the same boxes to several
+                  sizes while assigning and reordering them only once.
 
     Inputs:
     - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized
              coordinates. Possibly padded with zeros if not enough
              boxes to fill the array.
     - image_meta: [batch, (meta data)] Image details. See compose_image_meta()
+                  Only the padded image_shape is used. The window is not, so
+                  boxes that extend into the padding are pooled as is.
     - Feature maps: List of feature maps from different levels of the pyramid.
                     Each is [batch, height, width, channels]
 
     Output:
     Pooled regions in the shape: [batch, num_boxes, height, width, channels].
     The width and height are those specific in the pool_shape in the layer
-    constructor.
+    constructor. A list of them if pool_shape is a list of shapes.
     """
 
     def __init__(self, pool_shape, **kwargs):
         super(PyramidROIAlign, self).__init__(**kwargs)
-        self.pool_shape = tuple(pool_shape)
+        # A single [height, width] or a list of them
+        self.multi_output = isinstance(pool_shape[0], (list, tuple))
+        if self.multi_output:
+            self.pool_shapes = [tuple(p) for p in pool_shape]
+        else:
+            self.pool_shapes = [tuple(pool_shape)]
 
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
@@ -381,19 +440,24 @@ class PyramidROIAlign(KE.Layer):
         y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
         h = y2 - y1
         w = x2 - x1
-        # Use shape of first image. Images in a batch must have the same size.
-        image_shape = parse_image_meta_graph(image_meta)['image_shape'][0]
+        # Area of the padded input image that the boxes are normalized to,
+        # so that h * w * image_area is the box area in pixels. All images
+        # of a batch share the padded shape. Shaped [batch, 1, 1] to
+        # broadcast over the boxes.
+        image_shape = parse_image_meta_graph(image_meta)['image_shape']
+        image_area = tf.reshape(
+            tf.cast(image_shape[:, 0] * image_shape[:, 1], tf.float32), [-1, 1, 1])
         # Equation 1 in the Feature Pyramid Networks paper. Account for
         # the fact that our coordinates are normalized here.
         # e.g. a 224x224 ROI (in pixels) maps to P4
-        image_area = tf.cast(image_shape[0] * image_shape[1], tf.float32)
         roi_level = log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
         roi_level = tf.minimum(5, tf.maximum(
             2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
         roi_level = tf.squeeze(roi_level, 2)
 
         # Loop through levels and apply ROI pooling to each. P2 to P5.
-        pooled = []
+        # pooled holds a list of per-level results for each pool shape.
+        pooled = [[] for _ in self.pool_shapes]
         box_to_level = []
         for i, level in enumerate(range(2, 6)):
             ix = tf.where(tf.equal(roi_level, level))
@@ -418,35 +482,39 @@ class PyramidROIAlign(KE.Layer):
             # Here we use the simplified approach of a single value per bin,
             # which is how it's done in tf.crop_and_resize()
             # Result: [batch * num_boxes, pool_height, pool_width, channels]
-            pooled.append(tf.image.crop_and_resize(
-                feature_maps[i], level_boxes, box_indices, self.pool_shape,
-                method="bilinear"))
-
-        # Pack pooled features into one tensor
-        pooled = tf.concat(pooled, axis=0)
-
-        # Pack box_to_level mapping into one array and add another
-        # column representing the order of pooled boxes
-        box_to_level = tf.concat(box_to_level, axis=0)
-        box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
-        box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
-                                 axis=1)
-
-        # Rearrange pooled features to match the order of the original boxes
-        # Sort box_to_level by batch then box index
-        # TF doesn't have a way to sort by two columns, so merge them and sort.
-        sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
-        ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
-            box_to_level)[0]).indices[::-1]
-        ix = tf.gather(box_to_level[:, 2], ix)
-        pooled = tf.gather(pooled, ix)
-
-        # Re-add the batch dimension
-        pooled = tf.expand_dims(pooled, 0)
-        return pooled
+            for j, pool_shape in enumerate(self.pool_shapes):
+                pooled[j].append(tf.image.crop_and_resize(
+                    feature_maps[i], level_boxes, box_indices, pool_shape,
+                    method="bilinear"))
+
+        # Rearrange pooled features to match the order of the original boxes.
+        # Every box is assigned to exactly one level, so the flat positions
+        # (batch * num_boxes + box) of the pooled boxes are a permutation of
+        # all positions. Invert it to find the pooled box of each position.
+        box_to_level = tf.cast(tf.concat(box_to_level, axis=0), tf.int32)
+        positions = box_to_level[:, 0] * tf.shape(boxes)[1] + box_to_level[:, 1]
+        order = tf.invert_permutation(positions)
+
+        outputs = []
+        for level_pooled in pooled:
+            # Pack pooled features into one tensor and reorder
+            x = tf.gather(tf.concat(level_pooled, axis=0), order)
+            # Split the batch and box dimensions back out.
+            # [batch, num_boxes, pool_height, pool_width, channels]
+            shape = tf.concat([tf.shape(boxes)[:2], tf.shape(x)[1:]], axis=0)
+            static_shape = boxes.shape[:2].concatenate(x.shape[1:])
+            x = tf.reshape(x, shape)
+            x.set_shape(static_shape)
+            outputs.append(x)
+        return outputs if self.multi_output else outputs[0]
 
     def compute_output_shape(self, input_shape):
-        return input_shape[0][:2] + self.pool_shape + (input_shape[2][-1], )
+        shapes = [input_shape[0][:2] + p + (input_shape[2][-1], )
+                  for p in self.pool_shapes]
+        return shapes if self.multi_output else shapes[0]
+
+    def compute_mask(self, inputs, mask=None):
+        return [None] * len(self.pool_shapes) if self.multi_output else None
 
 
 ############################################################
@@ -684,6 +752,43 @@ class DetectionTargetLayer(KE.Layer):
 #  Detection Layer
 ############################################################
 
+def matrix_nms_graph(boxes, scores, class_ids, kernel="gaussian", sigma=2.0):
+    """Matrix NMS from SOLOv2. Decays the score of each box by its overlap
+    with the higher scoring boxes of the same class, all at once from the
+    IoU matrix rather than one box at a time.
+
+    boxes: [N, (y1, x1, y2, x2)]
+    scores: [N] box scores.
+    class_ids: [N] box class IDs.
+    kernel: "gaussian" or "linear" score decay.
+    sigma: Gaussian kernel width.
+
+    Returns: [N] decayed scores.
+    """
+    iou = overlaps_graph(boxes, boxes)
+    # Box i can only suppress box j if it's of the same class and has a
+    # higher score. Ties are broken by index.
+    index = tf.range(tf.shape(scores)[0])
+    higher = tf.logical_or(
+        scores[:, tf.newaxis] > scores[tf.newaxis],
+        tf.logical_and(tf.equal(scores[:, tf.newaxis], scores[tf.newaxis]),
+                       index[:, tf.newaxis] < index[tf.newaxis]))
+    same_class = tf.equal(class_ids[:, tf.newaxis], class_ids[tf.newaxis])
+    # Zero area boxes give NaN IoUs. They don't suppress anything.
+    mask = tf.logical_and(tf.logical_and(higher, same_class), tf.is_finite(iou))
+    decay_iou = tf.where(mask, iou, tf.zeros_like(iou))
+    # Max IoU of each box with a higher scoring box. If box i is itself
+    # suppressed, its effect on the lower boxes is compensated.
+    compensate_iou = tf.reduce_max(decay_iou, axis=0)[:, tf.newaxis]
+    if kernel == "gaussian":
+        decay = tf.exp(-sigma * (decay_iou ** 2 - compensate_iou ** 2))
+    elif kernel == "linear":
+        decay = (1 - decay_iou) / tf.maximum(1 - compensate_iou, 1e-6)
+    else:
+        raise Exception("Unknown matrix NMS kernel: {}".format(kernel))
+    return scores * tf.reduce_min(decay, axis=0)
+
+
 def refine_detections_graph(rois, probs, deltas, window, config):
     """Refine classified proposals and filter overlaps and return final
     detections.
@@ -724,43 +829,92 @@ def refine_detections_graph(rois, probs, deltas, window, config):
                                         tf.expand_dims(conf_keep, 0))
         keep = tf.sparse_tensor_to_dense(keep)[0]
 
-    # Apply per-class NMS
-    # 1. Prepare variables
+    # Prepare variables
     pre_nms_class_ids = tf.gather(class_ids, keep)
     pre_nms_scores = tf.gather(class_scores, keep)
     pre_nms_rois = tf.gather(refined_rois,   keep)
-    unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
-
-    def nms_keep_map(class_id):
-        """Apply Non-Maximum Suppression on ROIs of the given class."""
-        # Indices of ROIs of the given class
-        ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
-        # Apply NMS
-        class_keep = tf.image.non_max_suppression(
-                tf.gather(pre_nms_rois, ixs),
-                tf.gather(pre_nms_scores, ixs),
+
+    # Apply NMS
+    mode = config.DETECTION_NMS_MODE
+    if mode == "per_class":
+        unique_pre_nms_class_ids = tf.unique(pre_nms_class_ids)[0]
+
+        def nms_keep_map(class_id):
+            """Apply Non-Maximum Suppression on ROIs of the given class."""
+            # Indices of ROIs of the given class
+            ixs = tf.where(tf.equal(pre_nms_class_ids, class_id))[:, 0]
+            # Apply NMS
+            class_keep = tf.image.non_max_suppression(
+                    tf.gather(pre_nms_rois, ixs),
+                    tf.gather(pre_nms_scores, ixs),
+                    max_output_size=config.DETECTION_MAX_INSTANCES,
+                    iou_threshold=config.DETECTION_NMS_THRESHOLD)
+            # Map indicies
+            class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
+            # Pad with -1 so returned tensors have the same shape
+            gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
+            class_keep = tf.pad(class_keep, [(0, gap)],
+                                mode='CONSTANT', constant_values=-1)
+            # Set shape so map_fn() can infer result shape
+            class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
+            return class_keep
+
+        # 1. Map over class IDs
+        nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
+                             dtype=tf.int64)
+        # 2. Merge results into one list, and remove -1 padding
+        nms_keep = tf.reshape(nms_keep, [-1])
+        nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
+        # 3. Compute intersection between keep and nms_keep
+        keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
+                                        tf.expand_dims(nms_keep, 0))
+        keep = tf.sparse_tensor_to_dense(keep)[0]
+    elif mode in ["batched", "soft"]:
+        # Shift the boxes of each class to their own region so that boxes of
+        # different classes never overlap, and run a single NMS op. Boxes
+        # are normalized and clipped to the window, so an offset of 2 per
+        # class is enough. Adding the offset in float32 rounds the
+        # coordinates, so IoUs at the threshold can be decided differently
+        # than in per_class mode.
+        offset_rois = pre_nms_rois + \
+            2.0 * tf.to_float(pre_nms_class_ids)[:, tf.newaxis]
+        if mode == "batched":
+            nms_keep = tf.image.non_max_suppression(
+                offset_rois, pre_nms_scores,
                 max_output_size=config.DETECTION_MAX_INSTANCES,
                 iou_threshold=config.DETECTION_NMS_THRESHOLD)
-        # Map indicies
-        class_keep = tf.gather(keep, tf.gather(ixs, class_keep))
-        # Pad with -1 so returned tensors have the same shape
-        gap = config.DETECTION_MAX_INSTANCES - tf.shape(class_keep)[0]
-        class_keep = tf.pad(class_keep, [(0, gap)],
-                            mode='CONSTANT', constant_values=-1)
-        # Set shape so map_fn() can infer result shape
-        class_keep.set_shape([config.DETECTION_MAX_INSTANCES])
-        return class_keep
-
-    # 2. Map over class IDs
-    nms_keep = tf.map_fn(nms_keep_map, unique_pre_nms_class_ids,
-                         dtype=tf.int64)
-    # 3. Merge results into one list, and remove -1 padding
-    nms_keep = tf.reshape(nms_keep, [-1])
-    nms_keep = tf.gather(nms_keep, tf.where(nms_keep > -1)[:, 0])
-    # 4. Compute intersection between keep and nms_keep
-    keep = tf.sets.set_intersection(tf.expand_dims(keep, 0),
-                                    tf.expand_dims(nms_keep, 0))
-    keep = tf.sparse_tensor_to_dense(keep)[0]
+        else:
+            if not hasattr(tf.image, "non_max_suppression_with_scores"):
+                raise Exception("Soft-NMS requires TensorFlow 1.15 or newer")
+            # IoU threshold of 1 disables hard suppression so only the
+            # Gaussian score decay applies.
+            nms_keep, nms_scores = tf.image.non_max_suppression_with_scores(
+                offset_rois, pre_nms_scores,
+                max_output_size=config.DETECTION_MAX_INSTANCES,
+                iou_threshold=1.0,
+                score_threshold=config.DETECTION_NMS_MIN_SCORE,
+                soft_nms_sigma=config.DETECTION_SOFT_NMS_SIGMA)
+        keep = tf.gather(keep, nms_keep)
+        if mode == "soft":
+            # Report the decayed scores
+            class_scores = tf.scatter_nd(
+                tf.expand_dims(keep, 1), nms_scores,
+                tf.shape(class_scores, out_type=tf.int64))
+    elif mode == "matrix":
+        decayed_scores = matrix_nms_graph(
+            pre_nms_rois, pre_nms_scores, pre_nms_class_ids,
+            kernel=config.DETECTION_MATRIX_NMS_KERNEL,
+            sigma=config.DETECTION_MATRIX_NMS_SIGMA)
+        # Report the decayed scores
+        class_scores = tf.scatter_nd(
+            tf.expand_dims(keep, 1), decayed_scores,
+            tf.shape(class_scores, out_type=tf.int64))
+        matrix_keep = tf.where(
+            decayed_scores >= config.DETECTION_NMS_MIN_SCORE)[:, 0]
+        keep = tf.gather(keep, matrix_keep)
+    else:
+        raise Exception("Unknown DETECTION_NMS_MODE: {}".format(mode))
+
     # Keep top detections
     roi_count = config.DETECTION_MAX_INSTANCES
     class_scores_keep = tf.gather(class_scores, keep)
@@ -902,7 +1056,7 @@ def build_rpn_model(anchor_stride, anchors_per_location, depth):
 
 def fpn_classifier_graph(rois, feature_maps, image_meta,
                          pool_size, num_classes, train_bn=True,
-                         fc_layers_size=1024):
+                         fc_layers_size=1024, pooled=None):
     """Builds the computation graph of the feature pyramid network classifier
     and regressor heads.
 
@@ -915,6 +1069,9 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layres
     fc_layers_size: Size of the 2 FC layers
+    pooled: Optional. [batch, num_rois, pool_size, pool_size, channels] ROI
+            features already pooled from the feature maps. If given, the
+            head uses them instead of running its own ROI Align.
 
     Returns:
         logits: [N, NUM_CLASSES] classifier logits (before softmax)
@@ -924,8 +1081,10 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
     """
     # ROI Pooling
     # Shape: [batch, num_boxes, pool_height, pool_width, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_classifier")([rois, image_meta] + feature_maps)
+    if pooled is None:
+        pooled = PyramidROIAlign([pool_size, pool_size], name="roi_align_classifier")(
+            [rois, image_meta] + feature_maps)
+    x = pooled
     # Two 1024 FC layers (implemented with Conv2D for consistency)
     x = KL.TimeDistributed(KL.Conv2D(fc_layers_size, (pool_size, pool_size), padding="valid"),
                            name="mrcnn_class_conv1")(x)
@@ -957,7 +1116,7 @@ def fpn_classifier_graph(rois, feature_maps, image_meta,
 
 
 def build_fpn_mask_graph(rois, feature_maps, image_meta,
-                         pool_size, num_classes, train_bn=True):
+                         pool_size, num_classes, train_bn=True, pooled=None):
     """Builds the computation graph of the mask head of Feature Pyramid Network.
 
     rois: [batch, num_rois, (y1, x1, y2, x2)] Proposal boxes in normalized
@@ -968,13 +1127,18 @@ def build_fpn_mask_graph(rois, feature_maps, image_meta,
     pool_size: The width of the square feature map generated from ROI Pooling.
     num_classes: number of classes, which determines the depth of the results
     train_bn: Boolean. Train or freeze Batch Norm layres
+    pooled: Optional. [batch, num_rois, pool_size, pool_size, channels] ROI
+            features already pooled from the feature maps. If given, the
+            head uses them instead of running its own ROI Align.
 
     Returns: Masks [batch, roi_count, height, width, num_classes]
     """
     # ROI Pooling
     # Shape: [batch, boxes, pool_height, pool_width, channels]
-    x = PyramidROIAlign([pool_size, pool_size],
-                        name="roi_align_mask")([rois, image_meta] + feature_maps)
+    if pooled is None:
+        pooled = PyramidROIAlign([pool_size, pool_size], name="roi_align_mask")(
+            [rois, image_meta] + feature_maps)
+    x = pooled
 
     # Conv layers
     x = KL.TimeDistributed(KL.Conv2D(256, (3, 3), padding="same"),
@@ -1191,7 +1355,7 @@ def mrcnn_mask_loss_graph(target_masks, target_class_ids, pred_masks):
 ############################################################
 
 def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
-                  use_mini_mask=False):
+                  use_mini_mask=False, batch_shape=None, random_state=None):
     """Load and return ground truth data for an image (image, mask, bounding boxes).
 
     augment: (Depricated. Use augmentation instead). If true, apply random
@@ -1204,6 +1368,11 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
         224x224 and are generated by extracting the bounding box of the
         object and resizing it to MINI_MASK_SHAPE.
+    batch_shape: pad64_batch mode only. Optional [height, width] of the
+        batch to pad the image to. See utils.resize_image().
+    random_state: Optional. A np.random.RandomState for the random crop,
+        flip and augmentation. By default, they draw from the global random
+        generators of Python and imgaug.
 
     Returns:
     image: [height, width, 3]
@@ -1223,14 +1392,18 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         min_dim=config.IMAGE_MIN_DIM,
         min_scale=config.IMAGE_MIN_SCALE,
         max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
+        mode=config.IMAGE_RESIZE_MODE,
+        batch_shape=batch_shape,
+        random_state=random_state)
     mask = utils.resize_mask(mask, scale, padding, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
     if augment:
         logging.warning("'augment' is depricated. Use 'augmentation' instead.")
-        if random.randint(0, 1):
+        flip = random.randint(0, 1) if random_state is None \
+            else random_state.randint(0, 2)
+        if flip:
             image = np.fliplr(image)
             mask = np.fliplr(mask)
 
@@ -1255,6 +1428,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         mask_shape = mask.shape
         # Make augmenters deterministic to apply similarly to images and masks
         det = augmentation.to_deterministic()
+        if random_state is not None:
+            # Seed the copy rather than using imgaug's global random state
+            det.reseed(random_state.randint(2 ** 31), deterministic_too=True)
         image = det.augment_image(image)
         # Change mask to np.uint8 because imgaug doesn't support np.bool
         mask = det.augment_image(mask.astype(np.uint8),
@@ -1265,15 +1441,16 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         # Change mask back to bool
         mask = mask.astype(np.bool)
 
-    # Note that some boxes might be all zeros if the corresponding mask got cropped out.
-    # and here is to filter them out
-    _idx = np.sum(mask, axis=(0, 1)) > 0
-    mask = mask[:, :, _idx]
-    class_ids = class_ids[_idx]
     # Bounding boxes. Note that some boxes might be all zeros
     # if the corresponding mask got cropped out.
     # bbox: [num_instances, (y1, x1, y2, x2)]
     bbox = utils.extract_bboxes(mask)
+    # Filter out the instances with empty masks. Their boxes are all zeros
+    # and any other box has y2 > y1.
+    _idx = bbox[:, 2] > bbox[:, 0]
+    mask = mask[:, :, _idx]
+    class_ids = class_ids[_idx]
+    bbox = bbox[_idx]
 
     # Active classes
     # Different datasets have different classes, so track the
@@ -1293,7 +1470,310 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     return image, image_meta, class_ids, bbox, mask
 
 
-def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
+def _hash_update(h, value):
+    """Adds a value of the image or class info to a hashlib hash. NumPy
+    arrays are hashed by their bytes, because their repr() elides the
+    middle of large arrays. Lists, tuples and dicts are walked for them.
+    """
+    if isinstance(value, np.ndarray):
+        h.update(repr(("ndarray", value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(b"{")
+        for k in sorted(value, key=repr):
+            h.update(repr(k).encode())
+            _hash_update(h, value[k])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[" if isinstance(value, list) else b"(")
+        for v in value:
+            _hash_update(h, v)
+        h.update(b"]" if isinstance(value, list) else b")")
+    else:
+        h.update(repr(value).encode())
+        h.update(b",")
+
+
+class SampleCache(object):
+    """On-disk cache of the outputs of load_image_gt().
+
+    Resizing images and masks, extracting boxes and building mini masks
+    is deterministic without augmentation, so it's done once by build()
+    and stored in raw shard files. load() memory maps the shards and
+    returns views into them, so data generator workers read the samples
+    zero-copy and share the pages through the OS file cache.
+
+    With rpn_targets, the RPN target candidates of build_rpn_candidates()
+    are cached too. Only the random subsampling of sample_rpn_targets() is
+    left for training time. Negative anchors are stored as a bit per
+    anchor, and positive anchors as index lists.
+
+    The cache lives in a sub-directory of cache_dir named by a hash of the
+    config fields that load_image_gt() uses and of a fingerprint of the
+    dataset (image and class info, and the size and modification time of
+    image files). Changing either one builds a new cache rather than
+    reusing a stale one.
+
+    cache = SampleCache("/path/to/cache", dataset, config)
+    cache.build()
+    image, image_meta, class_ids, bbox, mask = cache.load(image_id)
+    """
+
+    # Config fields that change the output of load_image_gt()
+    CONFIG_FIELDS = ["IMAGE_RESIZE_MODE", "IMAGE_MIN_DIM", "IMAGE_MAX_DIM",
+                     "IMAGE_MIN_SCALE", "IMAGE_SHAPE", "USE_MINI_MASK",
+                     "MINI_MASK_SHAPE", "NUM_CLASSES"]
+    # Config fields that change the anchors, for the RPN candidates
+    RPN_CONFIG_FIELDS = ["BACKBONE", "COMPUTE_BACKBONE_SHAPE",
+                         "BACKBONE_STRIDES", "RPN_ANCHOR_SCALES",
+                         "RPN_ANCHOR_RATIOS", "RPN_ANCHOR_STRIDE"]
+
+    def __init__(self, cache_dir, dataset, config, shard_size=512,
+                 rpn_targets=False):
+        """
+        cache_dir: Directory to store caches in. Caches of different
+            configs and datasets are kept side by side.
+        shard_size: Number of images per shard file.
+        rpn_targets: If True, also cache the RPN target candidates. Needs
+            images of IMAGE_SHAPE, as data_generator() assumes.
+        """
+        assert config.IMAGE_RESIZE_MODE != "crop", \
+            "Crop mode picks random crops. It can't be cached."
+        assert config.IMAGE_RESIZE_MODE != "pad64_batch", \
+            "pad64_batch mode pads images to the shape of their batch. It can't be cached."
+        self.dataset = dataset
+        self.config = config
+        self.shard_size = shard_size
+        self.rpn_targets = rpn_targets
+        self.key = self.compute_key(dataset, config, rpn_targets)
+        self.cache_dir = os.path.join(cache_dir, self.key)
+        self._index = None
+        self._shards = {}
+
+    @classmethod
+    def compute_key(cls, dataset, config, rpn_targets=False):
+        """Returns a hash of the dataset and the config fields that affect
+        the cached samples.
+        """
+        h = hashlib.sha1()
+        fields = cls.CONFIG_FIELDS + (cls.RPN_CONFIG_FIELDS if rpn_targets else [])
+        for name in fields:
+            value = getattr(config, name)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif callable(value):
+                value = value.__name__
+            h.update(repr((name, value)).encode())
+        h.update(repr(("rpn_targets", rpn_targets)).encode())
+        _hash_update(h, dataset.class_info)
+        for info in dataset.image_info:
+            _hash_update(h, info)
+            path = info.get("path")
+            if isinstance(path, str) and os.path.isfile(path):
+                stat = os.stat(path)
+                h.update(repr((stat.st_size, stat.st_mtime_ns)).encode())
+        return h.hexdigest()[:16]
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, "index.npz")
+
+    def exists(self):
+        """True if the cache was fully built."""
+        return os.path.isfile(self.index_path)
+
+    def build(self, image_ids=None, verbose=1):
+        """Runs load_image_gt() on the images and writes the results to the
+        cache. Does nothing if the cache exists already.
+
+        image_ids: Optional. IDs of the images to cache. Default is all.
+        """
+        if self.exists():
+            return
+        if image_ids is None:
+            image_ids = self.dataset.image_ids
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        names = ["images", "masks"]
+        if self.rpn_targets:
+            names.append("rpn")
+            # Same anchors as data_generator()
+            anchors, anchor_index = training_anchors(self.config)
+
+        index = {name: [] for name in [
+            "shards", "image_offsets", "image_shapes", "mask_offsets",
+            "mask_shapes", "image_metas", "image_meta_dtypes",
+            "instance_counts", "class_ids", "boxes", "rpn_offsets",
+            "positive_counts", "positive_ids", "positive_gt_ids"]}
+        image_dtype = None
+        files = {}
+        try:
+            for i, image_id in enumerate(image_ids):
+                if i % self.shard_size == 0:
+                    # Start a new shard
+                    for f in files.values():
+                        f.close()
+                    shard = i // self.shard_size
+                    files = {name: open(self._shard_path(name, shard) + ".tmp", "wb")
+                             for name in names}
+                    if verbose:
+                        log("Caching images {} to {} of {}".format(
+                            i, min(i + self.shard_size, len(image_ids)), len(image_ids)))
+                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+                    load_image_gt(self.dataset, self.config, image_id,
+                                  use_mini_mask=self.config.USE_MINI_MASK)
+                image_dtype = image_dtype or image.dtype
+                assert image.dtype == image_dtype, \
+                    "All cached images must have the same dtype"
+                index["shards"].append(shard)
+                index["image_offsets"].append(files["images"].tell())
+                index["image_shapes"].append(image.shape)
+                files["images"].write(np.ascontiguousarray(image).tobytes())
+                index["mask_offsets"].append(files["masks"].tell())
+                index["mask_shapes"].append(gt_masks.shape)
+                files["masks"].write(np.ascontiguousarray(gt_masks, dtype=np.bool).tobytes())
+                index["image_metas"].append(image_meta)
+                index["image_meta_dtypes"].append(image_meta.dtype.str)
+                index["instance_counts"].append(gt_class_ids.shape[0])
+                index["class_ids"].append(gt_class_ids)
+                index["boxes"].append(gt_boxes.reshape([-1, 4]))
+
+                if self.rpn_targets:
+                    # data_generator() skips images without instances
+                    negatives = np.zeros([anchors.shape[0]], dtype=bool)
+                    positive_ids = positive_gt_ids = np.zeros([0], np.int32)
+                    if np.any(gt_class_ids > 0):
+                        positive_ids, positive_gt_ids, negative_ids = \
+                            build_rpn_candidates(anchors, gt_class_ids, gt_boxes,
+                                                 anchor_index=anchor_index)
+                        negatives[negative_ids] = True
+                    index["rpn_offsets"].append(files["rpn"].tell())
+                    files["rpn"].write(np.packbits(negatives).tobytes())
+                    index["positive_counts"].append(positive_ids.shape[0])
+                    index["positive_ids"].append(positive_ids)
+                    index["positive_gt_ids"].append(positive_gt_ids)
+        finally:
+            for f in files.values():
+                f.close()
+
+        # Move the finished shards in place, then write the index last. It
+        # marks the cache as complete.
+        for shard in set(index["shards"]):
+            for name in names:
+                path = self._shard_path(name, shard)
+                os.replace(path + ".tmp", path)
+        index_tmp = os.path.join(self.cache_dir, "index.tmp.npz")
+        np.savez(index_tmp,
+                 image_dtype=np.dtype(image_dtype or np.uint8).str,
+                 image_ids=np.array(image_ids, dtype=np.int64).reshape([-1]),
+                 shards=np.array(index["shards"], dtype=np.int32),
+                 image_offsets=np.array(index["image_offsets"], dtype=np.int64),
+                 image_shapes=np.array(index["image_shapes"], dtype=np.int32).reshape([-1, 3]),
+                 mask_offsets=np.array(index["mask_offsets"], dtype=np.int64),
+                 mask_shapes=np.array(index["mask_shapes"], dtype=np.int32).reshape([-1, 3]),
+                 # Stored as float64, which holds the values of any image
+                 # meta exactly, and cast back to the dtype of each on load
+                 image_metas=np.array(index["image_metas"], dtype=np.float64).reshape(
+                     [len(index["image_metas"]), -1]),
+                 image_meta_dtypes=np.array(index["image_meta_dtypes"], dtype="U8"),
+                 instance_offsets=np.cumsum([0] + index["instance_counts"]).astype(np.int64),
+                 class_ids=np.concatenate(index["class_ids"] + [np.zeros([0], np.int32)]).astype(np.int32),
+                 boxes=np.concatenate(index["boxes"] + [np.zeros([0, 4], np.int32)]).astype(np.int32),
+                 num_anchors=anchors.shape[0] if self.rpn_targets else 0,
+                 rpn_offsets=np.array(index["rpn_offsets"], dtype=np.int64),
+                 positive_offsets=np.cumsum([0] + index["positive_counts"]).astype(np.int64),
+                 positive_ids=np.concatenate(index["positive_ids"] + [np.zeros([0], np.int32)]),
+                 positive_gt_ids=np.concatenate(index["positive_gt_ids"] + [np.zeros([0], np.int32)]))
+        os.replace(index_tmp, self.index_path)
+
+    def _shard_path(self, name, shard):
+        return os.path.join(self.cache_dir, "{}_{:05d}.bin".format(name, shard))
+
+    def _shard(self, name, shard, dtype):
+        """Opens a shard as a read-only memory map. Maps are opened once
+        per process.
+        """
+        key = (name, shard)
+        if key not in self._shards:
+            path = self._shard_path(name, shard)
+            # Empty files can't be memory mapped
+            if os.path.getsize(path):
+                self._shards[key] = np.memmap(path, dtype=dtype, mode="r")
+            else:
+                self._shards[key] = np.zeros([0], dtype=dtype)
+        return self._shards[key]
+
+    def _position(self, image_id):
+        """Returns the position of an image in the index, or None if it's not
+        cached.
+        """
+        if self._index is None:
+            assert self.exists(), "Call build() before loading from the cache"
+            with np.load(self.index_path) as index:
+                self._index = {k: index[k] for k in index.files}
+            self._positions = {image_id: i for i, image_id
+                               in enumerate(self._index["image_ids"])}
+        return self._positions.get(image_id)
+
+    def load(self, image_id):
+        """Returns the cached load_image_gt() output of an image. Images that
+        aren't in the cache are loaded with load_image_gt().
+
+        The image and mask are read-only views into the memory mapped
+        shards. Copy them before modifying them.
+
+        Returns: image, image_meta, class_ids, bbox, mask. See load_image_gt().
+        """
+        i = self._position(image_id)
+        if i is None:
+            return load_image_gt(self.dataset, self.config, image_id,
+                                 use_mini_mask=self.config.USE_MINI_MASK)
+        index = self._index
+        shard = index["shards"][i]
+
+        shape = index["image_shapes"][i]
+        start = index["image_offsets"][i]
+        image = self._shard("images", shard, index["image_dtype"].item())[
+            start:start + np.prod(shape)].reshape(shape)
+        shape = index["mask_shapes"][i]
+        start = index["mask_offsets"][i]
+        mask = self._shard("masks", shard, np.bool)[
+            start:start + np.prod(shape)].reshape(shape)
+
+        start, end = index["instance_offsets"][i:i + 2]
+        class_ids = index["class_ids"][start:end]
+        bbox = index["boxes"][start:end]
+        image_meta = index["image_metas"][i].astype(index["image_meta_dtypes"][i])
+        return image, image_meta, class_ids, bbox, mask
+
+    def load_rpn_candidates(self, image_id):
+        """Returns the cached build_rpn_candidates() output of an image:
+        positive_ids, positive_gt_ids, negative_ids. Or None if the image
+        or the candidates are not cached.
+        """
+        i = self._position(image_id)
+        if i is None or not self.rpn_targets:
+            return None
+        index = self._index
+        num_anchors = index["num_anchors"].item()
+        row_size = (num_anchors + 7) // 8
+        start = index["rpn_offsets"][i]
+        negatives = self._shard("rpn", index["shards"][i], np.uint8)[start:start + row_size]
+        negative_ids = np.flatnonzero(
+            np.unpackbits(negatives, count=num_anchors)).astype(np.int32)
+        start, end = index["positive_offsets"][i:i + 2]
+        return (index["positive_ids"][start:end],
+                index["positive_gt_ids"][start:end], negative_ids)
+
+    def __getstate__(self):
+        # Memory maps are reopened in each process
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+
+def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config,
+                            random_state=None):
     """Generate targets for training Stage 2 classifier and mask heads.
     This is not used in normal training. It's useful for debugging or to train
     the Mask RCNN heads without using the RPN head.
@@ -1304,6 +1784,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes: [instance count, (y1, x1, y2, x2)]
     gt_masks: [height, width, instance count] Grund truth masks. Can be full
               size or mini-masks.
+    random_state: Optional. A np.random.RandomState to sample the ROIs
+        with. Defaults to the global NumPy generator.
 
     Returns:
     rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)]
@@ -1314,6 +1796,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
            to bbox boundaries and resized to neural network output size.
     """
     assert rpn_rois.shape[0] > 0
+    if random_state is None:
+        random_state = np.random
     assert gt_class_ids.dtype == np.int32, "Expected int but got {}".format(
         gt_class_ids.dtype)
     assert gt_boxes.dtype == np.int32, "Expected int but got {}".format(
@@ -1331,18 +1815,8 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     gt_boxes = gt_boxes[instance_ids]
     gt_masks = gt_masks[:, :, instance_ids]
 
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
     # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
 
     # Assign ROIs to GT boxes
     rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
@@ -1364,13 +1838,13 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     # FG
     fg_roi_count = int(config.TRAIN_ROIS_PER_IMAGE * config.ROI_POSITIVE_RATIO)
     if fg_ids.shape[0] > fg_roi_count:
-        keep_fg_ids = np.random.choice(fg_ids, fg_roi_count, replace=False)
+        keep_fg_ids = random_state.choice(fg_ids, fg_roi_count, replace=False)
     else:
         keep_fg_ids = fg_ids
     # BG
     remaining = config.TRAIN_ROIS_PER_IMAGE - keep_fg_ids.shape[0]
     if bg_ids.shape[0] > remaining:
-        keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+        keep_bg_ids = random_state.choice(bg_ids, remaining, replace=False)
     else:
         keep_bg_ids = bg_ids
     # Combine indicies of ROIs to keep
@@ -1387,12 +1861,12 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
             # Pick bg regions with easier IoU threshold
             bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
             assert bg_ids.shape[0] >= remaining
-            keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+            keep_bg_ids = random_state.choice(bg_ids, remaining, replace=False)
             assert keep_bg_ids.shape[0] == remaining
             keep = np.concatenate([keep, keep_bg_ids])
         else:
             # Fill the rest with repeated bg rois.
-            keep_extra_ids = np.random.choice(
+            keep_extra_ids = random_state.choice(
                 keep_bg_ids, remaining, replace=True)
             keep = np.concatenate([keep, keep_extra_ids])
     assert keep.shape[0] == config.TRAIN_ROIS_PER_IMAGE, \
@@ -1450,44 +1924,77 @@ def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
     return rois, roi_gt_class_ids, bboxes, masks
 
 
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_index=None, random_state=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
     anchors: [num_anchors, (y1, x1, y2, x2)]
     gt_class_ids: [num_gt_boxes] Integer class IDs.
     gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional. A utils.AnchorIndex built over the same anchors.
+        If provided, only anchors that intersect a GT box are scored.
+        The targets are the same as without it.
+    random_state: Optional. See sample_rpn_targets().
 
     Returns:
     rpn_match: [N] (int32) matches between anchors and GT boxes.
                1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
+    positive_ids, positive_gt_ids, negative_ids = build_rpn_candidates(
+        anchors, gt_class_ids, gt_boxes, anchor_index=anchor_index)
+    return sample_rpn_targets(anchors, gt_boxes, positive_ids, positive_gt_ids,
+                              negative_ids, config, random_state=random_state)
+
+
+def build_rpn_candidates(anchors, gt_class_ids, gt_boxes, anchor_index=None):
+    """Finds the anchors that can be picked as positive and negative RPN
+    targets. This is the deterministic part of build_rpn_targets(), so it
+    can be computed once per image and cached. See SampleCache.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [num_gt_boxes] Integer class IDs.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_index: Optional. A utils.AnchorIndex built over the same anchors.
+
+    Returns:
+    positive_ids: [positives] (int32) sorted indices of positive anchors.
+    positive_gt_ids: [positives] (int32) index of the GT box that each
+        positive anchor is matched to.
+    negative_ids: [negatives] (int32) sorted indices of negative anchors.
+    """
     # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
     rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
 
     # Handle COCO crowds
     # A crowd box in COCO is a bounding box around several instances. Exclude
     # them from training. A crowd box is given a negative class ID.
     crowd_ix = np.where(gt_class_ids < 0)[0]
+    non_crowd_ix = np.arange(gt_boxes.shape[0])
     if crowd_ix.shape[0] > 0:
-        # Filter out crowds from ground truth class IDs and boxes
+        # Filter out crowds from ground truth boxes
         non_crowd_ix = np.where(gt_class_ids > 0)[0]
         crowd_boxes = gt_boxes[crowd_ix]
-        gt_class_ids = gt_class_ids[non_crowd_ix]
         gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        # Compute max overlaps with crowd boxes [anchors]
+        if anchor_index is not None:
+            crowd_iou_max, _, _ = anchor_index.compute_overlaps_argmax(crowd_boxes)
+        else:
+            crowd_iou_max, _, _ = utils.compute_overlaps_argmax(anchors, crowd_boxes)
         no_crowd_bool = (crowd_iou_max < 0.001)
     else:
         # All anchors don't intersect a crowd
         no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
 
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    # Compute the per-anchor and per-GT box maxima of the overlaps
+    # [num_anchors, num_gt_boxes] without building the full matrix.
+    if anchor_index is not None:
+        anchor_iou_max, anchor_iou_argmax, gt_iou_argmax = \
+            anchor_index.compute_overlaps_argmax(gt_boxes)
+    else:
+        anchor_iou_max, anchor_iou_argmax, gt_iou_argmax = \
+            utils.compute_overlaps_argmax(anchors, gt_boxes)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -1499,69 +2006,76 @@ def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
     #
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
     rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
     # 2. Set an anchor for each GT box (regardless of IoU value).
     # TODO: If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argmax(overlaps, axis=0)
     rpn_match[gt_iou_argmax] = 1
     # 3. Set anchors with high overlap as positive.
     rpn_match[anchor_iou_max >= 0.7] = 1
 
+    # The closest GT box of an anchor might have IoU < 0.7. Indices are
+    # into the GT boxes given, crowds included.
+    positive_ids = np.where(rpn_match == 1)[0].astype(np.int32)
+    positive_gt_ids = non_crowd_ix[anchor_iou_argmax[positive_ids]].astype(np.int32)
+    negative_ids = np.where(rpn_match == -1)[0].astype(np.int32)
+    return positive_ids, positive_gt_ids, negative_ids
+
+
+def sample_rpn_targets(anchors, gt_boxes, positive_ids, positive_gt_ids,
+                       negative_ids, config, random_state=None):
+    """Randomly subsamples the candidates of build_rpn_candidates() to
+    balance positive and negative anchors, and computes the deltas of
+    the positive anchors. This is the random part of build_rpn_targets().
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    positive_ids, positive_gt_ids, negative_ids: See build_rpn_candidates().
+    random_state: Optional. A np.random.RandomState to subsample with.
+        Defaults to the global NumPy generator.
+
+    Returns:
+    rpn_match: [N] (int32) matches between anchors and GT boxes.
+               1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
+    """
+    if random_state is None:
+        random_state = np.random
+    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    rpn_match[negative_ids] = -1
+    rpn_match[positive_ids] = 1
+
     # Subsample to balance positive and negative anchors
     # Don't let positives be more than half the anchors
-    ids = np.where(rpn_match == 1)[0]
-    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    extra = len(positive_ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
     if extra > 0:
         # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(positive_ids, extra, replace=False)
         rpn_match[ids] = 0
     # Same for negative proposals
-    ids = np.where(rpn_match == -1)[0]
-    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
-                        np.sum(rpn_match == 1))
+    extra = len(negative_ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                                 np.sum(rpn_match == 1))
     if extra > 0:
         # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
+        ids = random_state.choice(negative_ids, extra, replace=False)
         rpn_match[ids] = 0
 
     # For positive anchors, compute shift and scale needed to transform them
     # to match the corresponding GT boxes.
-    ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
+    kept = rpn_match[positive_ids] == 1
+    ids = positive_ids[kept]
+    rpn_bbox[:ids.shape[0]] = utils.box_refinement(
+        anchors[ids], gt_boxes[positive_gt_ids[kept]])
+    # Normalize
+    rpn_bbox /= config.RPN_BBOX_STD_DEV
 
     return rpn_match, rpn_bbox
 
 
-def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
+def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes,
+                         random_state=None):
     """Generates ROI proposals similar to what a region proposal network
     would generate.
 
@@ -1569,9 +2083,13 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     count: Number of ROIs to generate
     gt_class_ids: [N] Integer ground truth class IDs
     gt_boxes: [N, (y1, x1, y2, x2)] Ground truth boxes in pixels.
+    random_state: Optional. A np.random.RandomState to draw the ROIs from.
+        Defaults to the global NumPy generator.
 
     Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
     """
+    if random_state is None:
+        random_state = np.random
     # placeholder
     rois = np.zeros((count, 4), dtype=np.int32)
 
@@ -1591,8 +2109,8 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
         # we need and filter out the extra. If we get fewer valid boxes
         # than we need, we loop and try again.
         while True:
-            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
-            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
+            y1y2 = random_state.randint(r_y1, r_y2, (rois_per_box * 2, 2))
+            x1x2 = random_state.randint(r_x1, r_x2, (rois_per_box * 2, 2))
             # Filter out zero area boxes
             threshold = 1
             y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
@@ -1615,8 +2133,8 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     # we need and filter out the extra. If we get fewer valid boxes
     # than we need, we loop and try again.
     while True:
-        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
-        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
+        y1y2 = random_state.randint(0, image_shape[0], (remaining_count * 2, 2))
+        x1x2 = random_state.randint(0, image_shape[1], (remaining_count * 2, 2))
         # Filter out zero area boxes
         threshold = 1
         y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
@@ -1635,8 +2153,303 @@ def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
     return rois
 
 
+def load_training_sample(dataset, config, image_id, anchors, anchor_index=None,
+                         augment=False, augmentation=None, random_rois=0,
+                         detection_targets=False, sample_cache=None,
+                         batch_shape=None, random_state=None):
+    """Loads an image and builds its training targets.
+
+    anchors: [anchor_count, (y1, x1, y2, x2)] Anchors of the image shape.
+    anchor_index: Optional. A utils.AnchorIndex built over the anchors.
+    sample_cache: Optional. A built SampleCache to load the image from.
+    batch_shape: pad64_batch mode only. The [height, width] of the batch
+        to pad the image to. The anchors must be those of this shape.
+    random_state: Optional. A np.random.RandomState for all the random
+        choices of the sample. By default, the global generators are used.
+    See data_generator() for the other arguments.
+
+    Returns None for images that have no instances. Otherwise a dict with:
+    image, image_meta, rpn_match, rpn_bbox, gt_class_ids, gt_boxes and
+    gt_masks. Also rpn_rois if random_rois is set, and rois,
+    mrcnn_class_ids, mrcnn_bbox and mrcnn_mask if detection_targets is set.
+    """
+    # Get GT bounding boxes and masks for image.
+    if sample_cache:
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            sample_cache.load(image_id)
+    else:
+        image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+            load_image_gt(dataset, config, image_id, augment=augment,
+                          augmentation=augmentation,
+                          use_mini_mask=config.USE_MINI_MASK,
+                          batch_shape=batch_shape, random_state=random_state)
+
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(gt_class_ids > 0):
+        return None
+
+    # RPN Targets. Only the random subsampling is left to do if the
+    # candidates are cached.
+    rpn_candidates = sample_cache.load_rpn_candidates(image_id) \
+        if sample_cache else None
+    if rpn_candidates:
+        rpn_match, rpn_bbox = sample_rpn_targets(anchors, gt_boxes,
+                                                 *rpn_candidates, config=config,
+                                                 random_state=random_state)
+    else:
+        rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
+                                                gt_class_ids, gt_boxes, config,
+                                                anchor_index=anchor_index,
+                                                random_state=random_state)
+    sample = {"image": image, "image_meta": image_meta,
+              "rpn_match": rpn_match, "rpn_bbox": rpn_bbox}
+
+    # Mask R-CNN Targets
+    if random_rois:
+        sample["rpn_rois"] = generate_random_rois(
+            image.shape, random_rois, gt_class_ids, gt_boxes,
+            random_state=random_state)
+        if detection_targets:
+            sample["rois"], sample["mrcnn_class_ids"], sample["mrcnn_bbox"], \
+                sample["mrcnn_mask"] = build_detection_targets(
+                    sample["rpn_rois"], gt_class_ids, gt_boxes, gt_masks, config,
+                    random_state=random_state)
+
+    # If more instances than fits in the array, sub-sample from them.
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids = (np.random if random_state is None else random_state).choice(
+            np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        gt_class_ids = gt_class_ids[ids]
+        gt_boxes = gt_boxes[ids]
+        gt_masks = gt_masks[:, :, ids]
+    sample["gt_class_ids"] = gt_class_ids
+    sample["gt_boxes"] = gt_boxes
+    sample["gt_masks"] = gt_masks
+    return sample
+
+
+def pack_training_batch(samples, config, out=None):
+    """Packs samples of load_training_sample() into a batch.
+
+    out: Optional. The (inputs, outputs) lists of arrays of a previous batch
+        of the same shapes to write this batch into, instead of allocating
+        new arrays. See SharedMemoryLoader.
+
+    Returns the inputs and outputs lists described in data_generator().
+    In pad64_batch mode, the inputs end with the anchors of the batch's
+    image shape, which the model takes as an input in this mode.
+    """
+    batch_size = len(samples)
+    sample = samples[0]
+    batch_anchors = None
+    # Optional targets of random ROIs and detection targets
+    extra_names = [name for name in ["rpn_rois", "rois", "mrcnn_class_ids",
+                                     "mrcnn_bbox", "mrcnn_mask"]
+                   if name in sample]
+
+    if out is None:
+        # Init batch arrays. Image metas are integers for unscaled images
+        # and floats for scaled ones, so use float64 to hold both exactly.
+        batch_image_meta = np.zeros(
+            (batch_size,) + sample["image_meta"].shape, dtype=np.float64)
+        batch_rpn_match = np.zeros(
+            [batch_size, sample["rpn_match"].shape[0], 1], dtype=sample["rpn_match"].dtype)
+        batch_rpn_bbox = np.zeros(
+            [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=sample["rpn_bbox"].dtype)
+        batch_images = np.zeros(
+            (batch_size,) + sample["image"].shape, dtype=np.float32)
+        batch_gt_class_ids = np.zeros(
+            (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
+        batch_gt_boxes = np.zeros(
+            (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
+        batch_gt_masks = np.zeros(
+            (batch_size, sample["gt_masks"].shape[0], sample["gt_masks"].shape[1],
+             config.MAX_GT_INSTANCES), dtype=sample["gt_masks"].dtype)
+        batch_extras = {name: np.zeros((batch_size,) + sample[name].shape,
+                                       dtype=sample[name].dtype)
+                        for name in extra_names}
+        if config.IMAGE_RESIZE_MODE == "pad64_batch":
+            batch_anchors = np.zeros(
+                (batch_size,) + pyramid_anchors(config, sample["image"].shape).shape,
+                dtype=np.float32)
+    else:
+        inputs, outputs = out
+        batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox, \
+            batch_gt_class_ids, batch_gt_boxes, batch_gt_masks = inputs[:7]
+        extras = list(inputs[7:])
+        if config.IMAGE_RESIZE_MODE == "pad64_batch":
+            batch_anchors = extras.pop()
+        # The class IDs output has an extra dimension
+        if outputs:
+            extras += [outputs[0][..., 0]] + list(outputs[1:])
+        batch_extras = dict(zip(extra_names, extras))
+
+    # Add to batch
+    for b, sample in enumerate(samples):
+        count = sample["gt_class_ids"].shape[0]
+        batch_image_meta[b] = sample["image_meta"]
+        batch_rpn_match[b] = sample["rpn_match"][:, np.newaxis]
+        batch_rpn_bbox[b] = sample["rpn_bbox"]
+        batch_images[b] = mold_image(sample["image"].astype(np.float32), config)
+        batch_gt_class_ids[b, :count] = sample["gt_class_ids"]
+        batch_gt_boxes[b, :count] = sample["gt_boxes"]
+        batch_gt_masks[b, :, :, :count] = sample["gt_masks"]
+        if out is not None:
+            # Clear the instances of the previous batch
+            batch_gt_class_ids[b, count:] = 0
+            batch_gt_boxes[b, count:] = 0
+            batch_gt_masks[b, :, :, count:] = 0
+        for name in extra_names:
+            batch_extras[name][b] = sample[name]
+    if batch_anchors is not None:
+        batch_anchors[:] = pyramid_anchors(config, sample["image"].shape,
+                                           normalized=True)
+
+    if out is not None:
+        return out
+
+    inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
+              batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
+    outputs = []
+
+    if "rpn_rois" in batch_extras:
+        inputs.extend([batch_extras["rpn_rois"]])
+        if "rois" in batch_extras:
+            inputs.extend([batch_extras["rois"]])
+            # Keras requires that output and targets have the same number of dimensions
+            batch_mrcnn_class_ids = np.expand_dims(
+                batch_extras["mrcnn_class_ids"], -1)
+            outputs.extend(
+                [batch_mrcnn_class_ids, batch_extras["mrcnn_bbox"],
+                 batch_extras["mrcnn_mask"]])
+    if batch_anchors is not None:
+        inputs.append(batch_anchors)
+    return inputs, outputs
+
+
+# Anchors of the image shapes seen by this process, shared by the data
+# generators and MaskRCNN.get_anchors(). Least recently used shapes are
+# dropped beyond ANCHOR_CACHE_SIZE. Data worker threads share it, so it's
+# only accessed under _anchor_cache_lock.
+ANCHOR_CACHE_SIZE = 32
+_anchor_cache = OrderedDict()
+_anchor_cache_lock = threading.Lock()
+
+
+def _cached_anchors(config, image_shape, kind, build):
+    """Returns the cached anchor data of an image shape, built by build()
+    on a miss. kind names the data: "pixels", "normalized" or "index".
+    build() runs under the cache lock, so it must not use the cache.
+    """
+    backbone_shapes = compute_backbone_shapes(config, image_shape)
+    key = (kind, tuple(image_shape[:2]),
+           tuple(tuple(s) for s in np.asarray(backbone_shapes).tolist()),
+           tuple(config.RPN_ANCHOR_SCALES), tuple(config.RPN_ANCHOR_RATIOS),
+           tuple(config.BACKBONE_STRIDES), config.RPN_ANCHOR_STRIDE)
+    with _anchor_cache_lock:
+        value = _anchor_cache.get(key)
+        if value is None:
+            value = build(backbone_shapes)
+            _anchor_cache[key] = value
+            if len(_anchor_cache) > ANCHOR_CACHE_SIZE:
+                _anchor_cache.popitem(last=False)
+        else:
+            _anchor_cache.move_to_end(key)
+    return value
+
+
+def pyramid_anchors(config, image_shape, normalized=False):
+    """Returns the anchor pyramid of an image shape. Cached per process.
+
+    normalized: If True, returns the anchors in normalized coordinates,
+        as the model takes them, rather than in pixels.
+
+    Returns: [anchor_count, (y1, x1, y2, x2)]
+    """
+    if normalized:
+        anchors = pyramid_anchors(config, image_shape)
+        return _cached_anchors(
+            config, image_shape, "normalized",
+            lambda _: utils.norm_boxes(anchors, image_shape[:2]))
+    return _cached_anchors(
+        config, image_shape, "pixels",
+        lambda backbone_shapes: utils.generate_pyramid_anchors(
+            config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+            backbone_shapes, config.BACKBONE_STRIDES,
+            config.RPN_ANCHOR_STRIDE))
+
+
+def training_anchors(config, image_shape=None):
+    """Returns the anchors used for the RPN targets, and a utils.AnchorIndex
+    over them if RPN_ANCHOR_MATCHING is "indexed". Both are cached.
+
+    image_shape: Optional. [height, width] of the batch's images. Defaults
+        to IMAGE_SHAPE.
+    """
+    if image_shape is None:
+        image_shape = config.IMAGE_SHAPE
+    # [anchor_count, (y1, x1, y2, x2)]
+    anchors = pyramid_anchors(config, image_shape)
+    anchor_index = _cached_anchors(
+        config, image_shape, "index",
+        lambda _: utils.AnchorIndex(anchors)) \
+        if config.RPN_ANCHOR_MATCHING == "indexed" else None
+    return anchors, anchor_index
+
+
+def aspect_ratio_batches(image_ids, shapes, batch_size, random_state=None):
+    """Splits images into batches of images of similar aspect ratio, so
+    that padding them to a common shape in pad64_batch mode wastes little.
+
+    Images of the same shape are batched together first. The rest are
+    sorted by aspect ratio and batched in that order.
+
+    image_ids: [N] Image IDs
+    shapes: [N, (height, width)] Shapes of the images after resizing.
+        See utils.resized_image_shape().
+    batch_size: Number of images per batch.
+    random_state: Optional. A np.random.RandomState to shuffle the images
+        within their groups and the order of the batches. Without it, the
+        images are kept in order.
+
+    Returns a list of arrays of image IDs. All batches are full but the
+    last one, which is last in the list.
+    """
+    image_ids = np.asarray(image_ids)
+    shapes = np.asarray(shapes).reshape([-1, 2])
+    order = np.arange(len(image_ids))
+    if random_state is not None:
+        order = random_state.permutation(order)
+    # Group the images by shape, in order of first appearance
+    groups = OrderedDict()
+    for i in order:
+        groups.setdefault(tuple(shapes[i]), []).append(i)
+    batches = []
+    rest = []
+    for group in groups.values():
+        full = len(group) - len(group) % batch_size
+        batches += [group[j:j + batch_size] for j in range(0, full, batch_size)]
+        rest += group[full:]
+    # Batch the remaining images by aspect ratio. A stable sort keeps them
+    # shuffled among equal ratios.
+    rest = np.asarray(rest, dtype=np.int64)
+    rest = rest[np.argsort(shapes[rest, 0] / shapes[rest, 1], kind="stable")]
+    batches += [rest[j:j + batch_size] for j in range(0, len(rest), batch_size)]
+    last = None
+    if batches and len(batches[-1]) < batch_size:
+        last = batches.pop()
+    if random_state is not None:
+        batches = [batches[j] for j in random_state.permutation(len(batches))]
+    if last is not None:
+        batches.append(last)
+    return [image_ids[np.asarray(b, dtype=np.int64)] for b in batches]
+
+
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
-                   random_rois=0, batch_size=1, detection_targets=False):
+                   random_rois=0, batch_size=1, detection_targets=False,
+                   sample_cache=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -1655,6 +2468,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     detection_targets: If True, generate detection targets (class IDs, bbox
         deltas, and masks). Typically for debugging or visualizations because
         in trainig detection targets are generated by DetectionTargetLayer.
+    sample_cache: Optional. A built SampleCache of the dataset to load the
+        images and ground truth from. Can't be used with augmentation.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The containtes
@@ -1674,19 +2489,17 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
     """
-    b = 0  # batch item index
+    assert sample_cache is None or not (augment or augmentation), \
+        "The sample cache holds samples without augmentation"
+    assert config.IMAGE_RESIZE_MODE != "pad64_batch", \
+        "Use DataSequence, which batches images by shape, in pad64_batch mode"
+    samples = []
     image_index = -1
     image_ids = np.copy(dataset.image_ids)
     error_count = 0
 
     # Anchors
-    # [anchor_count, (y1, x1, y2, x2)]
-    backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors, anchor_index = training_anchors(config)
 
     # Keras requires a generator to run indefinately.
     while True:
@@ -1696,107 +2509,23 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
             if shuffle and image_index == 0:
                 np.random.shuffle(image_ids)
 
-            # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
-            image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=augmentation,
-                              use_mini_mask=config.USE_MINI_MASK)
-
-            # Skip images that have no instances. This can happen in cases
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+            sample = load_training_sample(
+                dataset, config, image_id, anchors, anchor_index=anchor_index,
+                augment=augment, augmentation=augmentation,
+                random_rois=random_rois, detection_targets=detection_targets,
+                sample_cache=sample_cache)
+            # Skip images that have no instances
+            if sample is None:
                 continue
-
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
-
-            # Mask R-CNN Targets
-            if random_rois:
-                rpn_rois = generate_random_rois(
-                    image.shape, random_rois, gt_class_ids, gt_boxes)
-                if detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
-                        build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
-
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
-                if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
-                    if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
-            # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            if random_rois:
-                batch_rpn_rois[b] = rpn_rois
-                if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
-            b += 1
+            samples.append(sample)
 
             # Batch full?
-            if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
-
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
-
-                yield inputs, outputs
+            if len(samples) >= batch_size:
+                yield pack_training_batch(samples, config)
 
                 # start a new batch
-                b = 0
+                samples = []
         except (GeneratorExit, KeyboardInterrupt):
             raise
         except:
@@ -1808,6 +2537,366 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+class DataSequence(keras.utils.Sequence):
+    """A keras.utils.Sequence of training batches. Unlike data_generator(),
+    batches are addressed by index, so Keras can spread them over worker
+    processes without duplicating batches, and prefetches them in its
+    bounded queue.
+
+    The order of the images is shuffled at the start of each epoch from
+    seed and the epoch number. An epoch here is a full pass over the
+    images, len() batches, which is not a Keras epoch of STEPS_PER_EPOCH
+    steps unless the two are equal. The random parts of a batch (crops, flips,
+    imgaug augmentation, RPN target sampling, instance sub-sampling) draw
+    from a np.random.RandomState seeded from seed, the epoch and the batch
+    index, so a batch is the same in any worker process or thread. The
+    global random generators are left alone.
+
+    Images without instances are skipped and replaced by the next ones in
+    the epoch order, wrapping around at the end, so all batches are full.
+
+    In pad64_batch mode, the images are grouped into batches of similar
+    aspect ratio by aspect_ratio_batches(), from the image sizes in the
+    dataset's image info. Each batch is padded to the shape of its largest
+    image. Replacements of skipped images must fit in that shape.
+
+    dataset, config, augment, augmentation, random_rois, batch_size,
+    detection_targets, sample_cache: See data_generator().
+    shuffle: If True, shuffles the images before every epoch.
+    seed: Optional. Seed of the shuffling and sampling. Drawn at random
+        by default.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=False,
+                 augmentation=None, random_rois=0, batch_size=1,
+                 detection_targets=False, sample_cache=None, seed=None):
+        assert sample_cache is None or not (augment or augmentation), \
+            "The sample cache holds samples without augmentation"
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.augment = augment
+        self.augmentation = augmentation
+        self.random_rois = random_rois
+        self.batch_size = batch_size
+        self.detection_targets = detection_targets
+        self.sample_cache = sample_cache
+        self.seed = np.random.randint(2 ** 31) if seed is None else seed
+        self.image_ids = np.copy(dataset.image_ids)
+        self.anchors, self.anchor_index = training_anchors(config)
+        # Shapes of the resized images, to group them in pad64_batch mode
+        self.image_shapes = None
+        if config.IMAGE_RESIZE_MODE == "pad64_batch":
+            self.image_shapes = {
+                image_id: utils.resized_image_shape(
+                    *dataset.image_size(image_id),
+                    min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+                    min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)
+                for image_id in self.image_ids}
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, the number of full passes over the images done,
+        which picks the order of the images.
+        """
+        self.epoch = epoch
+        random_state = np.random.RandomState([self.seed, epoch]) \
+            if self.shuffle else None
+        if self.image_shapes:
+            # Consecutive batches of images of similar aspect ratios
+            self.order = np.concatenate(aspect_ratio_batches(
+                self.image_ids, [self.image_shapes[i] for i in self.image_ids],
+                self.batch_size, random_state=random_state))
+        elif self.shuffle:
+            self.order = random_state.permutation(self.image_ids)
+        else:
+            self.order = self.image_ids
+
+    def on_epoch_end(self):
+        self.set_epoch(self.epoch + 1)
+
+    def __len__(self):
+        return int(np.ceil(len(self.image_ids) / self.batch_size))
+
+    def __getitem__(self, idx):
+        return self.get_batch(idx)
+
+    def get_batch(self, idx, out=None):
+        """Builds batch idx of the current epoch.
+        out: Optional. Arrays to write the batch into. See
+            pack_training_batch().
+
+        Returns the inputs and outputs lists described in data_generator().
+        """
+        # Random state of this batch
+        random_state = np.random.RandomState([self.seed, self.epoch, idx])
+        position = idx * self.batch_size
+        if self.image_shapes:
+            # Pad to the largest image of the batch. If the replacements of
+            # images without instances don't fit, pad to the largest shape.
+            batch_shape = np.max([
+                self.image_shapes[self.order[(position + i) % len(self.order)]]
+                for i in range(self.batch_size)], axis=0)
+            samples = self._load_samples(position, random_state, batch_shape)
+            if len(samples) < self.batch_size:
+                samples = self._load_samples(position, random_state,
+                                             self.config.IMAGE_SHAPE[:2])
+        else:
+            samples = self._load_samples(position, random_state)
+        if len(samples) < self.batch_size:
+            raise Exception("Not enough images with instances to fill a batch.")
+        return pack_training_batch(samples, self.config, out=out)
+
+    def _load_samples(self, position, random_state, batch_shape=None):
+        """Loads the samples of a batch, starting at a position of the epoch
+        order. Returns fewer than batch_size samples if there aren't enough
+        images with instances that fit in batch_shape.
+        """
+        samples = []
+        error_count = 0
+        anchors, anchor_index = self.anchors, self.anchor_index
+        if batch_shape is not None:
+            anchors, anchor_index = training_anchors(self.config, batch_shape)
+        for i in range(len(self.order)):
+            image_id = self.order[(position + i) % len(self.order)]
+            if batch_shape is not None and \
+                    np.any(np.asarray(self.image_shapes[image_id]) > batch_shape):
+                # A replacement that doesn't fit in the batch
+                continue
+            try:
+                sample = load_training_sample(
+                    self.dataset, self.config, image_id, anchors,
+                    anchor_index=anchor_index, augment=self.augment,
+                    augmentation=self.augmentation,
+                    random_rois=self.random_rois,
+                    detection_targets=self.detection_targets,
+                    sample_cache=self.sample_cache,
+                    batch_shape=batch_shape, random_state=random_state)
+            except Exception:
+                # Log it and skip the image
+                logging.exception("Error processing image {}".format(
+                    self.dataset.image_info[image_id]))
+                error_count += 1
+                if error_count > 5:
+                    raise
+                continue
+            if sample is not None:
+                samples.append(sample)
+            if len(samples) == self.batch_size:
+                break
+        return samples
+
+
+def _batch_views(buffer, layout, input_count):
+    """Returns the (inputs, outputs) arrays of a batch laid out in a buffer.
+    layout: List of (shape, dtype) of the inputs then the outputs.
+    """
+    arrays = []
+    offset = 0
+    for shape, dtype in layout:
+        # np.frombuffer holds on to the buffer, so the shared memory can't
+        # be unmapped while a view is in use. np.ndarray(buffer=) doesn't.
+        arrays.append(np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)),
+                                    offset=offset).reshape(shape))
+        # Align each array to 64 bytes
+        offset += -(-arrays[-1].nbytes // 64) * 64
+    return arrays[:input_count], arrays[input_count:]
+
+
+def _shared_memory_worker(sequence, names, layout, input_count, tasks, done):
+    """Worker process of SharedMemoryLoader. Builds the batches it's asked
+    for in place in the shared memory slots.
+    """
+    from multiprocessing import shared_memory
+    buffers = [shared_memory.SharedMemory(name=name) for name in names]
+    slots = [_batch_views(b.buf, layout, input_count) for b in buffers]
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            epoch, idx, slot = task
+            try:
+                if sequence.epoch != epoch:
+                    sequence.set_epoch(epoch)
+                sequence.get_batch(idx, out=slots[slot])
+                done.put((slot, None))
+            except Exception:
+                done.put((slot, traceback.format_exc()))
+    finally:
+        del slots
+        for b in buffers:
+            b.close()
+
+
+class SharedMemoryLoader(object):
+    """Iterates over the batches of a DataSequence, epoch after epoch.
+    Worker processes write the batches straight into a ring of
+    preallocated shared memory slots, so batches are neither pickled
+    between processes nor allocated for every step.
+
+    The arrays returned by next() are views into a slot. The slot is
+    refilled once next() is called again, so use or copy a batch before
+    asking for the next one, as Keras does. A slot stays mapped after
+    close() for as long as its arrays are referenced.
+
+    Needs batches of a fixed shape, so images of a fixed size. The shapes
+    are taken from a probe batch. Requires Python 3.8+.
+
+    sequence: A DataSequence.
+    workers: Number of worker processes. Defaults to the number of CPUs.
+    slots: Number of batches in the ring. Defaults to workers + 2, which
+        keeps every worker busy while one batch is in use.
+    """
+
+    def __init__(self, sequence, workers=None, slots=None):
+        from multiprocessing import shared_memory
+        assert sequence.config.IMAGE_RESIZE_MODE in ["square", "crop"], \
+            "Shared memory batches need images of a fixed size"
+        self.sequence = sequence
+        self.workers = workers or multiprocessing.cpu_count()
+        slots = slots or self.workers + 2
+        assert slots >= 2, "At least two slots are needed"
+
+        # Layout of a batch from a probe batch
+        inputs, outputs = sequence.get_batch(0)
+        self.layout = [(a.shape, a.dtype) for a in inputs + outputs]
+        self.input_count = len(inputs)
+        slot_size = sum(-(-a.nbytes // 64) * 64 for a in inputs + outputs)
+        self.buffers = [shared_memory.SharedMemory(create=True, size=slot_size)
+                        for _ in range(slots)]
+        self.slots = [_batch_views(b.buf, self.layout, self.input_count)
+                      for b in self.buffers]
+
+        self.tasks = multiprocessing.Queue()
+        self.done = multiprocessing.Queue()
+        self.processes = [
+            multiprocessing.Process(
+                target=_shared_memory_worker, daemon=True,
+                args=(sequence, [b.name for b in self.buffers], self.layout,
+                      self.input_count, self.tasks, self.done))
+            for _ in range(self.workers)]
+        for p in self.processes:
+            p.start()
+
+        # Slots free to fill, slots being filled in batch order, finished
+        # slots, and the slot of the batch in use.
+        self._free = deque(range(slots))
+        self._pending = deque()
+        self._ready = set()
+        self._in_use = None
+        self.epoch = sequence.epoch
+        self.index = 0
+
+    def _submit(self):
+        """Hands the free slots to the workers, one batch each."""
+        while self._free:
+            slot = self._free.popleft()
+            self.tasks.put((self.epoch, self.index, slot))
+            self._pending.append(slot)
+            self.index += 1
+            if self.index == len(self.sequence):
+                self.index = 0
+                self.epoch += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # The previous batch is used up. Its slot can be refilled.
+        if self._in_use is not None:
+            self._free.append(self._in_use)
+            self._in_use = None
+        self._submit()
+
+        # Batches come back in the order they were asked for
+        slot = self._pending.popleft()
+        while slot not in self._ready:
+            done_slot, error = self.done.get()
+            if error:
+                self.close()
+                raise Exception("Error in data worker:\n" + error)
+            self._ready.add(done_slot)
+        self._ready.remove(slot)
+        self._in_use = slot
+        return self.slots[slot]
+
+    def close(self):
+        """Stops the workers and frees the shared memory."""
+        if not self.processes:
+            return
+        for _ in self.processes:
+            self.tasks.put(None)
+        for p in self.processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+        self.slots = []
+        for b in self.buffers:
+            try:
+                b.close()
+            except BufferError:
+                # A batch is still referenced. The memory is freed with it.
+                pass
+            b.unlink()
+
+    def __del__(self):
+        if hasattr(self, "processes"):
+            self.close()
+
+
+############################################################
+#  Evaluation
+############################################################
+
+# Dataset and config of the evaluation worker processes. Set once by
+# _init_eval_worker() rather than pickled with every task.
+_eval_dataset = None
+_eval_config = None
+
+
+def _init_eval_worker(dataset, config):
+    global _eval_dataset, _eval_config
+    _eval_dataset = dataset
+    _eval_config = config
+
+
+def load_eval_image(dataset, config, image_id):
+    """Loads an image and its ground truth for evaluation.
+
+    Returns:
+    image_id: The image ID.
+    molded_image: [height, width, 3] Resized and normalized image.
+    image_meta: Image meta data. See compose_image_meta().
+    gt_class_ids: [instance_count] Integer class IDs
+    gt_boxes: [instance_count, (y1, x1, y2, x2)] in the molded image.
+    gt_masks: List of RLE dicts of the masks in the molded image. Much
+        smaller than full size masks to send between processes.
+    """
+    image, image_meta, gt_class_ids, gt_boxes, gt_masks =\
+        load_image_gt(dataset, config, image_id)
+    return (image_id, mold_image(image, config), image_meta, gt_class_ids,
+            gt_boxes, utils.rle_encode_masks(gt_masks, gt_boxes))
+
+
+def _load_eval_image_worker(image_id):
+    return load_eval_image(_eval_dataset, _eval_config, image_id)
+
+
+def _match_eval_batch(evaluator, results, ground_truth):
+    """Encodes the raw masks of a batch of detections and adds them to
+    the evaluator. Runs in a background thread in MaskRCNN.evaluate().
+    ground_truth: List of (image_shape, gt_class_ids, gt_boxes, gt_masks).
+    """
+    for r, (image_shape, gt_class_ids, gt_boxes, gt_masks) in zip(results, ground_truth):
+        masks = [utils.rle_encode(crop, box, image_shape)
+                 for crop, box in zip(utils.unmold_mask_crops(r["masks"], r["rois"]),
+                                      r["rois"])]
+        evaluator.add(gt_boxes, gt_class_ids, gt_masks,
+                      r["rois"], r["class_ids"], r["scores"], masks)
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1876,10 +2965,18 @@ class MaskRCNN:
                     shape=[config.MINI_MASK_SHAPE[0],
                            config.MINI_MASK_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
+            elif config.IMAGE_RESIZE_MODE == "pad64_batch":
+                input_gt_masks = KL.Input(
+                    shape=[None, None, None],
+                    name="input_gt_masks", dtype=bool)
             else:
                 input_gt_masks = KL.Input(
                     shape=[config.IMAGE_SHAPE[0], config.IMAGE_SHAPE[1], None],
                     name="input_gt_masks", dtype=bool)
+            if config.IMAGE_RESIZE_MODE == "pad64_batch":
+                # The image shape changes from batch to batch, and so do
+                # the anchors. See pack_training_batch().
+                input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
         elif mode == "inference":
             # Anchors in normalized coordinates
             input_anchors = KL.Input(shape=[None, 4], name="input_anchors")
@@ -1920,7 +3017,7 @@ class MaskRCNN:
         mrcnn_feature_maps = [P2, P3, P4, P5]
 
         # Anchors
-        if mode == "training":
+        if mode == "training" and config.IMAGE_RESIZE_MODE != "pad64_batch":
             anchors = self.get_anchors(config.IMAGE_SHAPE)
             # Duplicate across the batch dimension because Keras requires it
             # TODO: can this be optimized to avoid duplicating the anchors?
@@ -1953,11 +3050,18 @@ class MaskRCNN:
         # and zero padded.
         proposal_count = config.POST_NMS_ROIS_TRAINING if mode == "training"\
             else config.POST_NMS_ROIS_INFERENCE
+        pre_nms_limit = config.PRE_NMS_LIMIT_TRAINING if mode == "training"\
+            else config.PRE_NMS_LIMIT_INFERENCE
+        proposal_inputs = [rpn_class, rpn_bbox, anchors]
+        if config.PRE_NMS_LIMIT_PER_LEVEL:
+            # rpn_class of each level, to find the level boundaries
+            proposal_inputs += [o[1] for o in layer_outputs]
         rpn_rois = ProposalLayer(
             proposal_count=proposal_count,
             nms_threshold=config.RPN_NMS_THRESHOLD,
+            pre_nms_limit=pre_nms_limit,
             name="ROI",
-            config=config)([rpn_class, rpn_bbox, anchors])
+            config=config)(proposal_inputs)
 
         if mode == "training":
             # Class ID mask to mark class IDs supported by the dataset the image
@@ -1984,19 +3088,28 @@ class MaskRCNN:
                 DetectionTargetLayer(config, name="proposal_targets")([
                     target_rois, input_gt_class_ids, gt_boxes, input_gt_masks])
 
+            # ROI Pooling. Both heads use the same ROIs in training, so pool
+            # them once for both pool sizes.
+            pooled_class, pooled_mask = PyramidROIAlign(
+                [[config.POOL_SIZE, config.POOL_SIZE],
+                 [config.MASK_POOL_SIZE, config.MASK_POOL_SIZE]],
+                name="roi_align_shared")([rois, input_image_meta] + mrcnn_feature_maps)
+
             # Network Heads
             # TODO: verify that this handles zero padded ROIs
             mrcnn_class_logits, mrcnn_class, mrcnn_bbox =\
                 fpn_classifier_graph(rois, mrcnn_feature_maps, input_image_meta,
                                      config.POOL_SIZE, config.NUM_CLASSES,
                                      train_bn=config.TRAIN_BN,
-                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE)
+                                     fc_layers_size=config.FPN_CLASSIF_FC_LAYERS_SIZE,
+                                     pooled=pooled_class)
 
             mrcnn_mask = build_fpn_mask_graph(rois, mrcnn_feature_maps,
                                               input_image_meta,
                                               config.MASK_POOL_SIZE,
                                               config.NUM_CLASSES,
-                                              train_bn=config.TRAIN_BN)
+                                              train_bn=config.TRAIN_BN,
+                                              pooled=pooled_mask)
 
             # TODO: clean up (use tf.identify if necessary)
             output_rois = KL.Lambda(lambda x: x * 1, name="output_rois")(rois)
@@ -2018,6 +3131,8 @@ class MaskRCNN:
                       input_rpn_match, input_rpn_bbox, input_gt_class_ids, input_gt_boxes, input_gt_masks]
             if not config.USE_RPN_ROIS:
                 inputs.append(input_rois)
+            if config.IMAGE_RESIZE_MODE == "pad64_batch":
+                inputs.append(input_anchors)
             outputs = [rpn_class_logits, rpn_class, rpn_bbox,
                        mrcnn_class_logits, mrcnn_class, mrcnn_bbox, mrcnn_mask,
                        rpn_rois, output_rois,
@@ -2266,7 +3381,8 @@ class MaskRCNN:
             "*epoch*", "{epoch:04d}")
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
-              augmentation=None, callbacks=[], use_multiprocessing=True):
+              augmentation=None, callbacks=[], use_multiprocessing=True,
+              shared_memory=False):
 
         """Train the model.
         train_dataset, val_dataset: Training and validation Dataset objects.
@@ -2294,6 +3410,9 @@ class MaskRCNN:
                     imgaug.augmenters.Fliplr(0.5),
                     imgaug.augmenters.GaussianBlur(sigma=(0.0, 5.0))
                 ])
+        shared_memory: If True, data worker processes write the batches into
+            shared memory instead of sending them through Keras' queues.
+            Needs images of a fixed size. See SharedMemoryLoader.
         """
         assert self.mode == "training", "Create model in training mode."
 
@@ -2311,12 +3430,35 @@ class MaskRCNN:
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        # Sample caches. Augmented samples change every epoch, so they're
+        # not cached.
+        train_cache = val_cache = None
+        if self.config.SAMPLE_CACHE_DIR:
+            if not augmentation:
+                train_cache = SampleCache(self.config.SAMPLE_CACHE_DIR,
+                                          train_dataset, self.config,
+                                          rpn_targets=self.config.CACHE_RPN_TARGETS)
+                train_cache.build()
+            val_cache = SampleCache(self.config.SAMPLE_CACHE_DIR,
+                                    val_dataset, self.config,
+                                    rpn_targets=self.config.CACHE_RPN_TARGETS)
+            val_cache.build()
+
+        # Data sequences. Keras spreads their batches over the workers.
+        train_generator = DataSequence(train_dataset, self.config, shuffle=True,
+                                       augmentation=augmentation,
+                                       batch_size=self.config.BATCH_SIZE,
+                                       sample_cache=train_cache)
+        val_generator = DataSequence(val_dataset, self.config, shuffle=True,
+                                     batch_size=self.config.BATCH_SIZE,
+                                     sample_cache=val_cache)
+        # Continue the shuffling of the previous epochs. The sequence counts
+        # passes over the dataset rather than Keras epochs. Keras starts a
+        # pass from its first batch, so resuming continues the same batches
+        # only if STEPS_PER_EPOCH is a multiple of len(train_generator).
+        # Otherwise the pass that was in progress starts over.
+        train_generator.set_epoch(
+            self.epoch * self.config.STEPS_PER_EPOCH // len(train_generator))
 
         # Callbacks (mod: extend with extra callbacks)
         callbacks = [
@@ -2340,18 +3482,32 @@ class MaskRCNN:
         else:
             workers = multiprocessing.cpu_count()
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=use_multiprocessing
-        )
+        # The shared memory loaders run their own workers. Keras reads from
+        # them in this process.
+        loaders = []
+        if shared_memory and workers:
+            loaders = [SharedMemoryLoader(train_generator, workers=workers),
+                       SharedMemoryLoader(val_generator, workers=max(1, workers // 4))]
+            train_generator, val_generator = loaders
+            workers = 0
+            use_multiprocessing = False
+
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=workers,
+                use_multiprocessing=use_multiprocessing
+            )
+        finally:
+            for loader in loaders:
+                loader.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2369,6 +3525,15 @@ class MaskRCNN:
         molded_images = []
         image_metas = []
         windows = []
+        batch_shape = None
+        if self.config.IMAGE_RESIZE_MODE == "pad64_batch":
+            # Pad all images to the shape of the largest one
+            batch_shape = np.max([utils.resized_image_shape(
+                image.shape[0], image.shape[1],
+                min_dim=self.config.IMAGE_MIN_DIM,
+                min_scale=self.config.IMAGE_MIN_SCALE,
+                max_dim=self.config.IMAGE_MAX_DIM,
+                mode=self.config.IMAGE_RESIZE_MODE) for image in images], axis=0)
         for image in images:
             # Resize image
             # TODO: move resizing to mold_image()
@@ -2377,7 +3542,8 @@ class MaskRCNN:
                 min_dim=self.config.IMAGE_MIN_DIM,
                 min_scale=self.config.IMAGE_MIN_SCALE,
                 max_dim=self.config.IMAGE_MAX_DIM,
-                mode=self.config.IMAGE_RESIZE_MODE)
+                mode=self.config.IMAGE_RESIZE_MODE,
+                batch_shape=batch_shape)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
             image_meta = compose_image_meta(
@@ -2394,7 +3560,7 @@ class MaskRCNN:
         return molded_images, image_metas, windows
 
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, mask_format="full"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -2405,13 +3571,16 @@ class MaskRCNN:
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        mask_format: How to return the masks. See detect().
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: [height, width, num_instances] Instance masks, or the format
+               given by mask_format
         """
+        assert mask_format in ["full", "cropped", "rle", "raw"]
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
         zero_ix = np.where(detections[:, 4] == 0)[0]
@@ -2448,36 +3617,48 @@ class MaskRCNN:
             N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        if mask_format == "full":
+            masks = utils.unmold_masks(masks, boxes, original_image_shape)
+        elif mask_format == "cropped":
+            masks = utils.unmold_mask_crops(masks, boxes)
+        elif mask_format == "rle":
+            masks = [utils.rle_encode(crop, box, original_image_shape)
+                     for crop, box in zip(utils.unmold_mask_crops(masks, boxes), boxes)]
 
-        return boxes, class_ids, scores, full_masks
+        return boxes, class_ids, scores, masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, mask_format="full"):
         """Runs the detection pipeline.
 
-        images: List of images, potentially of different sizes.
+        images: List of images, potentially of different sizes. Any number
+            of images can be given. They're run in batches of BATCH_SIZE,
+            see detect_generator().
+        mask_format: How to return the masks. One of:
+            full:    [H, W, N] instance binary masks. The default.
+            cropped: List of N binary masks, each cropped to its box in rois.
+            rle:     List of N COCO style uncompressed RLE dicts. See
+                     utils.rle_encode().
+            raw:     [N, height, width] float masks of the detected classes,
+                     as output by the network (usually 28x28), to be
+                     resized to the boxes in rois.
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or the format given by
+               mask_format
         """
         assert self.mode == "inference", "Create model in inference mode."
-        assert len(
-            images) == self.config.BATCH_SIZE, "len(images) must be equal to BATCH_SIZE"
 
         if verbose:
             log("Processing {} images".format(len(images)))
             for image in images:
                 log("image", image)
 
+        if len(images) != self.config.BATCH_SIZE:
+            return list(self.detect_generator(images, mask_format=mask_format))
+
         # Mold inputs to format expected by the neural network
         molded_images, image_metas, windows = self.mold_inputs(images)
 
@@ -2488,47 +3669,57 @@ class MaskRCNN:
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        return self._detect_batch(molded_images, image_metas, windows,
+                                  [image.shape for image in images],
+                                  verbose=verbose, mask_format=mask_format)
 
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
-        # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
-        # Process detections
-        results = []
-        for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       windows[i])
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
-        return results
+    def detect_generator(self, images, mask_format="full"):
+        """Runs the detection pipeline on any number of images.
+
+        images: List or iterator of images, potentially of different sizes.
+            All the images of a batch must mold to the same size.
+        mask_format: How to return the masks. See detect().
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+        Images are split into batches of BATCH_SIZE. The last batch is
+        padded, and the results of the padding are dropped. The next batch
+        is molded in a background thread while the model runs on the
+        current one.
+
+        Yields one dict per image, in order. See detect().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        images = iter(images)
+        batch_size = self.config.BATCH_SIZE
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as molder:
+            batch = list(itertools.islice(images, batch_size))
+            molded = molder.submit(self.mold_inputs, batch) if batch else None
+            while molded:
+                molded_images, image_metas, windows = molded.result()
+                image_shapes = [image.shape for image in batch]
+                # Mold the next batch while this one runs
+                batch = list(itertools.islice(images, batch_size))
+                molded = molder.submit(self.mold_inputs, batch) if batch else None
+                for result in self._detect_batch(molded_images, image_metas, windows,
+                                                 image_shapes, mask_format=mask_format):
+                    yield result
+
+    def detect_molded(self, molded_images, image_metas, verbose=0,
+                      mask_format="full"):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also retruned by load_image_gt()
+        mask_format: How to return the masks. See detect().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks, or the format given by
+               mask_format
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(molded_images) == self.config.BATCH_SIZE,\
@@ -2545,8 +3736,34 @@ class MaskRCNN:
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
+        # The molded images are the original images
+        windows = [[0, 0, image.shape[0], image.shape[1]] for image in molded_images]
+        return self._detect_batch(molded_images, image_metas, windows,
+                                  [image.shape for image in molded_images],
+                                  verbose=verbose, mask_format=mask_format)
+
+    def _detect_batch(self, molded_images, image_metas, windows, image_shapes,
+                      verbose=0, mask_format="full"):
+        """Runs the model on a batch of up to BATCH_SIZE molded images of
+        the same size. Shorter batches are padded by repeating the last
+        image, and the padding results are dropped.
+
+        windows: [N, (y1, x1, y2, x2)] The portion of each molded image that
+            has the original image.
+        image_shapes: Shapes of the original images.
+
+        Returns a list of result dicts. See detect().
+        """
+        count = len(molded_images)
+        padding = self.config.BATCH_SIZE - count
+        if padding:
+            molded_images = np.concatenate(
+                [molded_images, np.repeat(molded_images[-1:], padding, axis=0)])
+            image_metas = np.concatenate(
+                [image_metas, np.repeat(image_metas[-1:], padding, axis=0)])
+
         # Anchors
-        anchors = self.get_anchors(image_shape)
+        anchors = self.get_anchors(molded_images[0].shape)
         # Duplicate across the batch dimension because Keras requires it
         # TODO: can this be optimized to avoid duplicating the anchors?
         anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
@@ -2560,12 +3777,11 @@ class MaskRCNN:
             self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
         # Process detections
         results = []
-        for i, image in enumerate(molded_images):
-            window = [0, 0, image.shape[0], image.shape[1]]
+        for i in range(count):
             final_rois, final_class_ids, final_scores, final_masks =\
                 self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       window)
+                                       image_shapes[i], molded_images[i].shape,
+                                       windows[i], mask_format=mask_format)
             results.append({
                 "rois": final_rois,
                 "class_ids": final_class_ids,
@@ -2574,27 +3790,104 @@ class MaskRCNN:
             })
         return results
 
+    def evaluate(self, dataset, image_ids=None, iou_thresholds=None,
+                 workers=None, verbose=1):
+        """Runs detection on a dataset and computes the dataset-level mask
+        AP and AR. See utils.APEvaluator.
+
+        Images are loaded and molded in a pool of worker processes, and the
+        detections are matched in background threads, so both overlap with
+        the model predicting the next batch. Images that mold to different
+        shapes are put in separate batches.
+
+        dataset: A Dataset object with ground truth masks.
+        image_ids: Optional. IDs of the images to evaluate. Default is all.
+        iou_thresholds: Optional. IoU thresholds to match at. Default is
+            0.5 to 0.95 with increments of 0.05.
+        workers: Number of processes that load images. Defaults to the
+            number of CPUs. 0 loads them in this process.
+
+        Returns the results dict of utils.APEvaluator.evaluate().
+        """
+        assert self.mode == "inference", "Create model in inference mode."
+        if image_ids is None:
+            image_ids = dataset.image_ids
+        image_ids = list(image_ids)
+        if workers is None:
+            # Same work-around for Windows as in train()
+            workers = 0 if os.name == 'nt' else multiprocessing.cpu_count()
+        batch_size = self.config.BATCH_SIZE
+        evaluator = utils.APEvaluator(iou_thresholds)
+
+        # Bound the images being loaded and the batches waiting to be
+        # matched, so memory stays flat on large datasets.
+        max_loading = 2 * workers + batch_size if workers else 1
+        max_matching = 2
+        pool = multiprocessing.Pool(workers, _init_eval_worker,
+                                    (dataset, self.config)) if workers else None
+        matcher = concurrent.futures.ThreadPoolExecutor(max_workers=max_matching)
+        loading = deque()
+        matching = deque()
+
+        def run_batch(samples):
+            # Pad the last batch by repeating its last image
+            padded = samples + samples[-1:] * (batch_size - len(samples))
+            results = self.detect_molded(np.stack([s[1] for s in padded]),
+                                         np.stack([s[2] for s in padded]),
+                                         mask_format="raw")
+            ground_truth = [(s[1].shape, s[3], s[4], s[5]) for s in samples]
+            matching.append(matcher.submit(
+                _match_eval_batch, evaluator, results[:len(samples)], ground_truth))
+            while len(matching) > max_matching:
+                matching.popleft().result()
+
+        try:
+            next_id = 0
+            samples = []
+            while loading or next_id < len(image_ids):
+                # Keep the workers busy
+                while next_id < len(image_ids) and len(loading) < max_loading:
+                    if pool:
+                        loading.append(pool.apply_async(
+                            _load_eval_image_worker, (image_ids[next_id],)))
+                    else:
+                        loading.append(load_eval_image(dataset, self.config,
+                                                       image_ids[next_id]))
+                    next_id += 1
+                sample = loading.popleft()
+                if pool:
+                    sample = sample.get()
+                if samples and sample[1].shape != samples[0][1].shape:
+                    run_batch(samples)
+                    samples = []
+                samples.append(sample)
+                if len(samples) == batch_size:
+                    run_batch(samples)
+                    samples = []
+            if samples:
+                run_batch(samples)
+            while matching:
+                matching.popleft().result()
+        finally:
+            matcher.shutdown()
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if verbose:
+            log("Evaluated {} images".format(evaluator.image_count))
+        return evaluator.evaluate(verbose=verbose)
+
     def get_anchors(self, image_shape):
-        """Returns anchor pyramid for the given image size."""
-        backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
-        if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
-                self.config.RPN_ANCHOR_SCALES,
-                self.config.RPN_ANCHOR_RATIOS,
-                backbone_shapes,
-                self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
-            # Keep a copy of the latest anchors in pixel coordinates because
-            # it's used in inspect_model notebooks.
-            # TODO: Remove this after the notebook are refactored to not use it
-            self.anchors = a
-            # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
-        return self._anchor_cache[tuple(image_shape)]
+        """Returns anchor pyramid for the given image size, in normalized
+        coordinates. The anchors are cached per process and shared with
+        the training data. See pyramid_anchors().
+        """
+        # Keep a copy of the latest anchors in pixel coordinates because
+        # it's used in inspect_model notebooks.
+        # TODO: Remove this after the notebook are refactored to not use it
+        self.anchors = pyramid_anchors(self.config, image_shape)
+        return pyramid_anchors(self.config, image_shape, normalized=True)
 
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
@@ -19,6 +19,7 @@ import skimage.io
 import skimage.transform
 import urllib.request
 import shutil
+import threading
 import warnings
 
 # URL from which to download the latest COCO trained weights
@@ -68,30 +69,33 @@ def crop_image_by_mask(image, mask, same_dim=False):
 #  Bounding Boxes
 ############################################################
 
-def extract_bboxes(mask):
+def extract_bboxes(mask, packed_width=None):
     """Compute bounding boxes from masks.
     mask: [height, width, num_instances]. Mask pixels are either 1 or 0.
+    packed_width: Optional. If given, mask is np.packbits(mask, axis=1) of
+        a mask that was packed_width pixels wide, which is 8x smaller to
+        store and scan.
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    # Rows and columns that have any mask pixels. [height or width, instances]
+    rows = np.any(mask, axis=1)
+    if packed_width is None:
+        cols = np.any(mask, axis=0)
+    else:
+        cols = np.unpackbits(np.bitwise_or.reduce(mask, axis=0),
+                             axis=0)[:packed_width].astype(bool)
+    # First and last rows and columns with mask pixels.
+    # x2 and y2 should not be part of the box, so count them from the end.
+    y1 = np.argmax(rows, axis=0)
+    y2 = rows.shape[0] - np.argmax(rows[::-1], axis=0)
+    x1 = np.argmax(cols, axis=0)
+    x2 = cols.shape[0] - np.argmax(cols[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(rows, axis=0)] = 0
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -115,82 +119,225 @@ def compute_iou(box, boxes, box_area, boxes_area):
     return iou
 
 
-def compute_overlaps(boxes1, boxes2):
+def _overlaps_chunks(boxes1, boxes2, chunk_size):
+    """Yields (start, overlaps) pairs where overlaps is the IoU matrix of
+    boxes1[start:start + chunk_size] against all of boxes2. Used to bound the
+    size of the temporary arrays when boxes1 is large (e.g. anchors).
+    """
+    # Areas of anchors and GT boxes
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    b2_y1, b2_x1, b2_y2, b2_x2 = [boxes2[np.newaxis, :, i] for i in range(4)]
+
+    for start in range(0, boxes1.shape[0], chunk_size):
+        b1 = boxes1[start:start + chunk_size]
+        # Intersections [chunk, boxes2 count]
+        y1 = np.maximum(b1[:, 0, np.newaxis], b2_y1)
+        y2 = np.minimum(b1[:, 2, np.newaxis], b2_y2)
+        x1 = np.maximum(b1[:, 1, np.newaxis], b2_x1)
+        x2 = np.minimum(b1[:, 3, np.newaxis], b2_x2)
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = area2[np.newaxis] + area1[start:start + chunk_size, np.newaxis] \
+            - intersection
+        yield start, intersection / union
+
+
+def compute_overlaps(boxes1, boxes2, chunk_size=1024, out=None):
     """Computes IoU overlaps between two sets of boxes.
     boxes1, boxes2: [N, (y1, x1, y2, x2)].
+    chunk_size: Number of boxes1 rows to process at once. Bounds the
+        temporary arrays to [chunk_size, boxes2 count].
+    out: Optional. A preallocated float32 array of shape
+        [boxes1 count, boxes2 count] to write the overlaps into.
 
     For better performance, pass the largest set first and the smaller second.
+
+    Returns: [boxes1 count, boxes2 count] float32 IoU overlaps.
     """
-    # Areas of anchors and GT boxes
-    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
-    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    if out is None:
+        out = np.empty((boxes1.shape[0], boxes2.shape[0]), dtype=np.float32)
+    assert out.shape == (boxes1.shape[0], boxes2.shape[0])
+    for start, overlaps in _overlaps_chunks(boxes1, boxes2, chunk_size):
+        out[start:start + overlaps.shape[0]] = overlaps
+    return out
 
-    # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
-    overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
-    return overlaps
+
+def compute_overlaps_argmax(boxes1, boxes2, chunk_size=1024):
+    """Same as np.max/np.argmax over the rows and the columns of
+    compute_overlaps(boxes1, boxes2), but without building the full matrix.
+    Ties resolve to the lowest index, like np.argmax.
+
+    Returns:
+    iou_max: [boxes1 count] Max IoU of each boxes1 box with any boxes2 box.
+    iou_argmax: [boxes1 count] Index of the boxes2 box with the max IoU.
+    col_argmax: [boxes2 count] Index of the boxes1 box with the max IoU
+        for each boxes2 box.
+    """
+    iou_max = np.zeros([boxes1.shape[0]])
+    iou_argmax = np.zeros([boxes1.shape[0]], dtype=np.int64)
+    col_max = np.full([boxes2.shape[0]], -np.inf)
+    col_argmax = np.zeros([boxes2.shape[0]], dtype=np.int64)
+    if boxes2.shape[0] == 0:
+        return iou_max, iou_argmax, col_argmax
+    for start, overlaps in _overlaps_chunks(boxes1, boxes2, chunk_size):
+        end = start + overlaps.shape[0]
+        iou_argmax[start:end] = np.argmax(overlaps, axis=1)
+        iou_max[start:end] = overlaps[np.arange(overlaps.shape[0]),
+                                      iou_argmax[start:end]]
+        # Only replace on strictly larger values to keep the first max
+        chunk_argmax = np.argmax(overlaps, axis=0)
+        chunk_max = overlaps[chunk_argmax, np.arange(overlaps.shape[1])]
+        better = chunk_max > col_max
+        col_max[better] = chunk_max[better]
+        col_argmax[better] = chunk_argmax[better] + start
+    return iou_max, iou_argmax, col_argmax
+
+
+# Number of set bits of each byte value
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x):
+    """Counts the set bits of a uint8 array."""
+    if hasattr(np, "bitwise_count"):
+        # Native popcount in NumPy 2.0+
+        return np.bitwise_count(x).sum()
+    return _POPCOUNT_TABLE[x].sum()
+
+
+def _pack_masks(masks):
+    """Binarizes a mask stack and packs the bounding box crop of each mask
+    to bits, for compute_overlaps_masks().
+    masks: [height, width, N]
+
+    Returns:
+    packed: list of N [box height, box width in bytes] uint8 crops, packed
+        along the width.
+    boxes: [N, (y1, x1, y2, x2)] crop boxes, with x1 and x2 in bytes.
+    areas: [N] float32 mask areas.
+    """
+    if masks.dtype != bool:
+        masks = masks > .5
+    boxes = extract_bboxes(masks)
+    # Round the crops out to whole bytes so crops of different masks align
+    boxes[:, 1] //= 8
+    boxes[:, 3] = (boxes[:, 3] + 7) // 8
+    packed = [np.packbits(masks[y1:y2, x1 * 8:x2 * 8, i], axis=1)
+              for i, (y1, x1, y2, x2) in enumerate(boxes)]
+    areas = np.array([_popcount(p) for p in packed], dtype=np.float32)
+    return packed, boxes, areas
+
+
+def _as_rles(masks):
+    """Returns a list of RLE dicts as is, and encodes a [height, width, N]
+    mask stack to a list of RLE dicts, binarized as in
+    compute_overlaps_masks().
+    """
+    if isinstance(masks, list):
+        return masks
+    if masks.dtype != bool:
+        masks = masks > .5
+    return rle_encode_masks(masks, extract_bboxes(masks))
 
 
 def compute_overlaps_masks(masks1, masks2):
     '''Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances], or lists of RLE dicts (see
+        rle_encode()), which are compared without decoding them. If only
+        one is a list, the other is encoded to RLE.
+
+    Masks are packed to bits, and intersections are only counted for pairs
+    whose boxes intersect, on the crop of the box intersection.
     '''
-    
+    if isinstance(masks1, list) or isinstance(masks2, list):
+        return rle_iou(_as_rles(masks1), _as_rles(masks2))
+
     # If either set of masks is empty return empty result
     if masks1.shape[0] == 0 or masks2.shape[0] == 0:
         return np.zeros((masks1.shape[0], masks2.shape[-1]))
-    # flatten masks and compute their areas
-    masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
-    masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
-    area1 = np.sum(masks1, axis=0)
-    area2 = np.sum(masks2, axis=0)
-
-    # intersections and union
-    intersections = np.dot(masks1.T, masks2)
+    if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
+        return np.zeros((masks1.shape[-1], masks2.shape[-1]), dtype=np.float32)
+    packed1, boxes1, area1 = _pack_masks(masks1)
+    packed2, boxes2, area2 = _pack_masks(masks2)
+
+    # intersections of the pairs with intersecting boxes
+    y1 = np.maximum(boxes1[:, np.newaxis, 0], boxes2[np.newaxis, :, 0])
+    x1 = np.maximum(boxes1[:, np.newaxis, 1], boxes2[np.newaxis, :, 1])
+    y2 = np.minimum(boxes1[:, np.newaxis, 2], boxes2[np.newaxis, :, 2])
+    x2 = np.minimum(boxes1[:, np.newaxis, 3], boxes2[np.newaxis, :, 3])
+    intersections = np.zeros([masks1.shape[-1], masks2.shape[-1]], dtype=np.float32)
+    for i, j in zip(*np.where((y2 > y1) & (x2 > x1))):
+        # Crop both masks to the box intersection
+        m1 = packed1[i][y1[i, j] - boxes1[i, 0]:y2[i, j] - boxes1[i, 0],
+                        x1[i, j] - boxes1[i, 1]:x2[i, j] - boxes1[i, 1]]
+        m2 = packed2[j][y1[i, j] - boxes2[j, 0]:y2[i, j] - boxes2[j, 0],
+                        x1[i, j] - boxes2[j, 1]:x2[i, j] - boxes2[j, 1]]
+        intersections[i, j] = _popcount(m1 & m2)
+
+    # union
     union = area1[:, None] + area2[None, :] - intersections
     overlaps = intersections / union
 
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def non_max_suppression(boxes, scores, threshold, max_output=None,
+                        class_ids=None, tile_size=128):
     """Performs non-maximum supression and returns indicies of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    max_output: Optional. Stop after picking this many boxes.
+    class_ids: Optional. [N] class IDs. If given, boxes only suppress boxes
+        of the same class, which runs per-class NMS in one call.
+    tile_size: Number of boxes to compute IoU for at a time. Bounds the
+        temporary arrays to [tile_size, N].
+
+    Returns: indicies of the kept boxes, highest score first.
     """
     assert boxes.shape[0] > 0
     if boxes.dtype.kind != "f":
         boxes = boxes.astype(np.float32)
 
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
-    # Get indicies of boxes sorted by scores (highest first)
+    # Sort boxes by scores (highest first)
     ixs = scores.argsort()[::-1]
+    boxes = boxes[ixs]
+    if class_ids is not None:
+        class_ids = np.asarray(class_ids)[ixs]
 
+    keep = np.ones([boxes.shape[0]], dtype=bool)
     pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indicies into ixs[1:], so add 1 to get
-        # indicies into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indicies of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    for start in range(0, boxes.shape[0], tile_size):
+        # Boxes of this tile that survived the previous tiles, and all the
+        # surviving boxes from the tile onward that they might suppress.
+        rows = np.where(keep[start:start + tile_size])[0] + start
+        if rows.shape[0] == 0:
+            continue
+        cols = np.where(keep[start:])[0] + start
+        _, iou = next(_overlaps_chunks(boxes[rows], boxes[cols], rows.shape[0]))
+        # A box can only suppress boxes with lower scores
+        suppress = (iou > threshold) & (cols[np.newaxis] > rows[:, np.newaxis])
+        if class_ids is not None:
+            suppress &= class_ids[rows, np.newaxis] == class_ids[np.newaxis, cols]
+        # Greedy pass within the tile. The first rows.shape[0] columns
+        # are the tile boxes themselves.
+        n = rows.shape[0]
+        alive = np.ones([n], dtype=bool)
+        picked = []
+        for r in range(n):
+            if not alive[r]:
+                continue
+            picked.append(r)
+            if max_output is not None and len(pick) + len(picked) >= max_output:
+                break
+            alive &= ~suppress[r, :n]
+        pick.extend(rows[picked])
+        if max_output is not None and len(pick) >= max_output:
+            break
+        # Boxes of the later tiles overlapping any picked box are dropped
+        keep[rows] = False
+        keep[cols[n:][np.any(suppress[picked, n:], axis=0)]] = False
+    return np.array(ixs[pick], dtype=np.int32)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -245,28 +392,32 @@ def box_refinement_graph(box, gt_box):
 
 def box_refinement(box, gt_box):
     """Compute refinement needed to transform box to gt_box.
-    box and gt_box are [N, (y1, x1, y2, x2)]. (y2, x2) is
-    assumed to be outside the box.
+    box and gt_box are [..., (y1, x1, y2, x2)]. (y2, x2) is
+    assumed to be outside the box. Any number of box pairs is
+    encoded in one pass, and the leading dimensions broadcast,
+    so a single GT box can be passed for many boxes.
+
+    Returns: [..., (dy, dx, log(dh), log(dw))] float32 deltas.
     """
-    box = box.astype(np.float32)
-    gt_box = gt_box.astype(np.float32)
+    box = np.asarray(box).astype(np.float32, copy=False)
+    gt_box = np.asarray(gt_box).astype(np.float32, copy=False)
 
-    height = box[:, 2] - box[:, 0]
-    width = box[:, 3] - box[:, 1]
-    center_y = box[:, 0] + 0.5 * height
-    center_x = box[:, 1] + 0.5 * width
+    height = box[..., 2] - box[..., 0]
+    width = box[..., 3] - box[..., 1]
+    center_y = box[..., 0] + 0.5 * height
+    center_x = box[..., 1] + 0.5 * width
 
-    gt_height = gt_box[:, 2] - gt_box[:, 0]
-    gt_width = gt_box[:, 3] - gt_box[:, 1]
-    gt_center_y = gt_box[:, 0] + 0.5 * gt_height
-    gt_center_x = gt_box[:, 1] + 0.5 * gt_width
+    gt_height = gt_box[..., 2] - gt_box[..., 0]
+    gt_width = gt_box[..., 3] - gt_box[..., 1]
+    gt_center_y = gt_box[..., 0] + 0.5 * gt_height
+    gt_center_x = gt_box[..., 1] + 0.5 * gt_width
 
     dy = (gt_center_y - center_y) / height
     dx = (gt_center_x - center_x) / width
     dh = np.log(gt_height / height)
     dw = np.log(gt_width / width)
 
-    return np.stack([dy, dx, dh, dw], axis=1)
+    return np.stack([dy, dx, dh, dw], axis=-1)
 
 
 ############################################################
@@ -319,6 +470,16 @@ class Dataset(object):
         image_info.update(kwargs)
         self.image_info.append(image_info)
 
+    def image_size(self, image_id):
+        """Returns the (height, width) of an image from the "height" and
+        "width" of its image info. Images added without them are loaded
+        once and their size is recorded in the image info.
+        """
+        info = self.image_info[image_id]
+        if "height" not in info or "width" not in info:
+            info["height"], info["width"] = self.load_image(image_id).shape[:2]
+        return info["height"], info["width"]
+
     def image_reference(self, image_id):
         """Return a link to the image in its source Website or details about
         the image that help looking it up or debugging it.
@@ -432,7 +593,50 @@ class Dataset(object):
         return mask, class_ids
 
 
-def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+def _resize_scale(h, w, min_dim=None, max_dim=None, min_scale=None, mode="square"):
+    """Returns the scale that resize_image() resizes an image of size
+    [h, w] with.
+    """
+    scale = 1
+    if mode == "none":
+        return scale
+    # Scale?
+    if min_dim:
+        # Scale up but not down
+        scale = max(1, min_dim / min(h, w))
+    if min_scale and scale < min_scale:
+        scale = min_scale
+
+    # Does it exceed max dim?
+    if max_dim and mode in ["square", "pad64_batch"]:
+        image_max = max(h, w)
+        if round(image_max * scale) > max_dim:
+            scale = max_dim / image_max
+    return scale
+
+
+def resized_image_shape(h, w, min_dim=None, max_dim=None, min_scale=None,
+                        mode="square"):
+    """Returns the [height, width] of an image of size [h, w] after
+    resize_image(), without loading or resizing the image. In pad64_batch
+    mode, this is the smallest shape of a batch the image can be put in.
+    See resize_image() for the arguments.
+    """
+    if mode == "square":
+        return max_dim, max_dim
+    if mode == "crop":
+        return min_dim, min_dim
+    scale = _resize_scale(h, w, min_dim, max_dim, min_scale, mode)
+    if scale != 1:
+        h, w = round(h * scale), round(w * scale)
+    if mode in ["pad64", "pad64_batch"]:
+        # Round up to multiples of 64
+        h, w = -(-h // 64) * 64, -(-w // 64) * 64
+    return h, w
+
+
+def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square",
+                 batch_shape=None, random_state=None):
     """Resizes an image keeping the aspect ratio unchanged.
 
     min_dim: if provided, resizes the image such that it's smaller
@@ -454,6 +658,15 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
               on min_dim and min_scale, then picks a random crop of
               size min_dim x min_dim. Can be used in training only.
               max_dim is not used in this mode.
+        pad64_batch: Scales the image like square, then pads the bottom and
+              right with zeros to batch_shape, or to multiples of 64 if
+              batch_shape isn't given. Images of a batch are padded to the
+              batch's common shape rather than to a square.
+    batch_shape: pad64_batch mode only. Optional [height, width] to pad
+        to, in multiples of 64. Must hold the image after scaling. See
+        resized_image_shape().
+    random_state: crop mode only. Optional np.random.RandomState to pick
+        the crop with. Uses the random module by default.
 
     Returns:
     image: the resized image
@@ -476,18 +689,7 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
     if mode == "none":
         return image, window, scale, padding, crop
 
-    # Scale?
-    if min_dim:
-        # Scale up but not down
-        scale = max(1, min_dim / min(h, w))
-    if min_scale and scale < min_scale:
-        scale = min_scale
-
-    # Does it exceed max dim?
-    if max_dim and mode == "square":
-        image_max = max(h, w)
-        if round(image_max * scale) > max_dim:
-            scale = max_dim / image_max
+    scale = _resize_scale(h, w, min_dim, max_dim, min_scale, mode)
 
     # Resize image using bilinear interpolation
     if scale != 1:
@@ -527,11 +729,27 @@ def resize_image(image, min_dim=None, max_dim=None, min_scale=None, mode="square
         padding = [(top_pad, bottom_pad), (left_pad, right_pad), (0, 0)]
         image = np.pad(image, padding, mode='constant', constant_values=0)
         window = (top_pad, left_pad, h + top_pad, w + left_pad)
+    elif mode == "pad64_batch":
+        h, w = image.shape[:2]
+        if batch_shape is None:
+            batch_shape = resized_image_shape(h, w, mode="pad64")
+        assert batch_shape[0] % 64 == 0 and batch_shape[1] % 64 == 0, \
+            "Batch shape must be a multiple of 64"
+        assert batch_shape[0] >= h and batch_shape[1] >= w, \
+            "Batch shape {} is smaller than the image".format(batch_shape)
+        # Pad the bottom and right, so the window is the same in any batch
+        padding = [(0, batch_shape[0] - h), (0, batch_shape[1] - w), (0, 0)]
+        image = np.pad(image, padding, mode='constant', constant_values=0)
+        window = (0, 0, h, w)
     elif mode == "crop":
         # Pick a random crop
         h, w = image.shape[:2]
-        y = random.randint(0, (h - min_dim))
-        x = random.randint(0, (w - min_dim))
+        if random_state is None:
+            y = random.randint(0, (h - min_dim))
+            x = random.randint(0, (w - min_dim))
+        else:
+            y = random_state.randint(0, h - min_dim + 1)
+            x = random_state.randint(0, w - min_dim + 1)
         crop = (y, x, min_dim, min_dim)
         image = image[y:y + min_dim, x:x + min_dim]
         window = (0, 0, min_dim, min_dim)
@@ -562,41 +780,102 @@ def resize_mask(mask, scale, padding, crop=None):
     return mask
 
 
+def _resize_weights(size, source_size):
+    """Bilinear interpolation indices and weights to resize an axis from
+    source_size to size pixels. Uses the pixel centers of
+    skimage.transform.resize(), and like its mode="constant", pixels
+    outside the source read as zero.
+
+    size: int. Size of the resized axis.
+    source_size: Size of the source axis. Int or [N, 1] array for N axes.
+
+    Returns: (i0, w0, i1, w1) of shape [size] or [N, size]. Resized pixels
+        are w0 * source[i0] + w1 * source[i1].
+    """
+    coords = (np.arange(size) + 0.5) * (source_size / size) - 0.5
+    i0 = np.floor(coords).astype(np.int64)
+    i1 = i0 + 1
+    w1 = coords - i0
+    w0 = 1 - w1
+    # Zero the weights of neighbors outside the source. Only happens when
+    # upsampling, within half a pixel of the edges.
+    last = source_size - 1
+    w0 = np.where(i0 < 0, 0, w0)
+    w1 = np.where(i1 > last, 0, w1)
+    return np.maximum(i0, 0), w0, np.minimum(i1, last), w1
+
+
+def _resize_bilinear(image, shape):
+    """Resizes a 2D array with separable bilinear interpolation. Same as
+    skimage.transform.resize(order=1, mode="constant") without
+    anti-aliasing, including clipping to the value range of the input.
+    image: [height, width] array.
+    shape: (height, width) of the output.
+
+    Returns: float [height, width] array.
+    """
+    ya, wya, yb, wyb = _resize_weights(shape[0], image.shape[0])
+    xa, wxa, xb, wxb = _resize_weights(shape[1], image.shape[1])
+    image = image.astype(np.float64)
+    resized = wxa * image[:, xa] + wxb * image[:, xb]
+    resized = wya[:, np.newaxis] * resized[ya] + wyb[:, np.newaxis] * resized[yb]
+    return np.clip(resized, image.min(), image.max())
+
+
 def minimize_mask(bbox, mask, mini_shape):
     """Resize masks to a smaller version to reduce memory load.
     Mini-masks can be resized back to image scale using expand_masks()
 
+    All instances are resampled at once with one bilinear gather. Same
+    interpolation as skimage.transform.resize(order=1, mode="constant")
+    without anti-aliasing. Results can differ only on pixels that
+    interpolate to within float rounding of 0.5.
+
     See inspect_data.ipynb notebook for more details.
     """
-    mini_mask = np.zeros(mini_shape + (mask.shape[-1],), dtype=bool)
-    for i in range(mask.shape[-1]):
-        # Pick slice and cast to bool in case load_mask() returned wrong dtype
-        m = mask[:, :, i].astype(bool)
-        y1, x1, y2, x2 = bbox[i][:4]
-        m = m[y1:y2, x1:x2]
-        if m.size == 0:
-            raise Exception("Invalid bounding box with area of zero")
-        # Resize with bilinear interpolation
-        m = skimage.transform.resize(m, mini_shape, order=1, mode="constant")
-        mini_mask[:, :, i] = np.around(m).astype(np.bool)
-    return mini_mask
+    bbox = np.asarray(bbox)[:, :4].astype(np.int64)
+    y1, x1, y2, x2 = [bbox[:, k, np.newaxis] for k in range(4)]
+    if np.any((y2 <= y1) | (x2 <= x1)):
+        raise Exception("Invalid bounding box with area of zero")
+    # Sampling rows and columns of each mini mask in image coordinates.
+    # [instances, mini height or mini width]
+    ya, wya, yb, wyb = _resize_weights(mini_shape[0], y2 - y1)
+    xa, wxa, xb, wxb = _resize_weights(mini_shape[1], x2 - x1)
+    ya, yb, wya, wyb = [a[:, :, np.newaxis] for a in [ya + y1, yb + y1, wya, wyb]]
+    xa, xb, wxa, wxb = [a[:, np.newaxis] for a in [xa + x1, xb + x1, wxa, wxb]]
+    i = np.arange(mask.shape[-1])[:, np.newaxis, np.newaxis]
+    # Gather the 4 neighbors of every mini mask pixel of every instance.
+    # Cast to bool in case load_mask() returned wrong dtype.
+    # [instances, mini height, mini width]
+    m = wya * (wxa * (mask[ya, xa, i] != 0) + wxb * (mask[ya, xb, i] != 0)) + \
+        wyb * (wxa * (mask[yb, xa, i] != 0) + wxb * (mask[yb, xb, i] != 0))
+    # skimage clips the result to the value range of the source, so a box
+    # that's entirely mask stays entirely mask. The zero weights above only
+    # apply to boxes smaller than the mini mask, so only check those.
+    small = np.where((y2 - y1 < mini_shape[0]) | (x2 - x1 < mini_shape[1]))[0]
+    for k in small:
+        if np.all(mask[bbox[k, 0]:bbox[k, 2], bbox[k, 1]:bbox[k, 3], k]):
+            m[k] = 1
+    # Same as np.around() on values in [0, 1], which rounds 0.5 down
+    return np.moveaxis(m > 0.5, 0, -1)
 
 
 def expand_mask(bbox, mini_mask, image_shape):
     """Resizes mini masks back to image size. Reverses the change
     of minimize_mask().
 
+    Uses the same interpolation as minimize_mask(), applied separably:
+    each mini mask is interpolated along x to the box width and then
+    along y to the box height.
+
     See inspect_data.ipynb notebook for more details.
     """
     mask = np.zeros(image_shape[:2] + (mini_mask.shape[-1],), dtype=bool)
     for i in range(mask.shape[-1]):
-        m = mini_mask[:, :, i]
         y1, x1, y2, x2 = bbox[i][:4]
-        h = y2 - y1
-        w = x2 - x1
-        # Resize with bilinear interpolation
-        m = skimage.transform.resize(m, (h, w), order=1, mode="constant")
-        mask[y1:y2, x1:x2, i] = np.around(m).astype(np.bool)
+        m = _resize_bilinear(mini_mask[:, :, i], (y2 - y1, x2 - x1))
+        # Same as np.around() on values in [0, 1], which rounds 0.5 down
+        mask[y1:y2, x1:x2, i] = m > 0.5
     return mask
 
 
@@ -615,8 +894,7 @@ def unmold_mask(mask, bbox, image_shape):
     """
     threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = skimage.transform.resize(mask, (y2 - y1, x2 - x1), order=1, mode="constant")
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
+    mask = _resize_bilinear(mask, (y2 - y1, x2 - x1)) >= threshold
 
     # Put the mask in the right location.
     full_mask = np.zeros(image_shape[:2], dtype=np.bool)
@@ -624,6 +902,282 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def unmold_mask_crops(masks, boxes, threshold=0.5):
+    """Resizes masks generated by the neural network to the size of their
+    boxes, without pasting them into full size images.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    threshold: Mask pixels >= threshold are set.
+
+    Returns: list of N bool arrays, each [y2 - y1, x2 - x1].
+    """
+    return [_resize_bilinear(masks[i], (y2 - y1, x2 - x1)) >= threshold
+            for i, (y1, x1, y2, x2) in enumerate(boxes[:, :4])]
+
+
+def unmold_masks(masks, boxes, image_shape, out=None, threshold=0.5,
+                 label_map=False):
+    """Pastes masks generated by the neural network into one full size
+    array. Only the box crops are resized, and no per-instance full size
+    masks are created.
+    masks: [N, height, width] of type float. Small, typically 28x28 masks.
+    boxes: [N, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [height, width, ...] of the image.
+    out: Optional. Preallocated array to write into, to reuse a buffer
+        across images. [height, width, N] bool, or [height, width] integer
+        if label_map is True. It's cleared first.
+    threshold: Mask pixels >= threshold are set.
+    label_map: If True, returns a single [height, width] int32 map where
+        each pixel holds 1 + the index of the instance covering it, or 0
+        for background. Where instances overlap, the one that comes first
+        wins, which is the highest scoring one for detections.
+
+    Returns: [height, width, N] bool masks, or the label map.
+    """
+    boxes = np.asarray(boxes)
+    if out is None:
+        if label_map:
+            out = np.zeros(image_shape[:2], dtype=np.int32)
+        else:
+            out = np.zeros(image_shape[:2] + (boxes.shape[0],), dtype=bool)
+    else:
+        out.fill(0)
+    crops = unmold_mask_crops(masks, boxes, threshold)
+    if label_map:
+        # Paste in reverse so earlier instances end up on top
+        for i in reversed(range(len(crops))):
+            y1, x1, y2, x2 = boxes[i, :4]
+            out[y1:y2, x1:x2][crops[i]] = i + 1
+    else:
+        for i, crop in enumerate(crops):
+            y1, x1, y2, x2 = boxes[i, :4]
+            out[y1:y2, x1:x2, i] = crop
+    return out
+
+
+############################################################
+#  Run-Length Encoding
+############################################################
+
+def rle_encode(mask, box=None, image_shape=None, compress=False):
+    """Encodes a binary mask with the COCO run-length encoding.
+    Runs are counted in column-major order and alternate between 0s and
+    1s, starting with 0s.
+
+    mask: [height, width] binary mask. Either the full image mask, or, if
+        box is given, the crop of the mask inside the box.
+    box: Optional. [y1, x1, y2, x2] location of the crop in the image. The
+        image outside the box is treated as 0s, without creating the full
+        size mask.
+    image_shape: [height, width, ...] of the image. Required with box.
+    compress: If True, counts is the compressed string used in COCO
+        annotation files and by pycocotools, rather than a list.
+
+    Returns: {"size": [height, width], "counts": [run lengths]}
+    """
+    if box is None:
+        y1, x1 = 0, 0
+        height, width = mask.shape[:2]
+    else:
+        y1, x1 = box[:2]
+        height, width = image_shape[:2]
+    # Pad each column with 0s so every run of 1s starts and ends within it
+    columns = np.zeros([mask.shape[1], mask.shape[0] + 2], dtype=np.int8)
+    columns[:, 1:-1] = mask.T != 0
+    col, row = np.where(np.diff(columns, axis=1) != 0)
+    # Positions of run starts and ends in the column-major order of the image.
+    # They alternate between starts of 1s and starts of 0s.
+    changes = (x1 + col) * height + y1 + row
+    # A run that reaches the bottom of one column and continues at the top of
+    # the next shows up as an end and a start at the same position.
+    merged = np.zeros(changes.shape, dtype=bool)
+    merged[1:] = changes[1:] == changes[:-1]
+    merged[:-1] |= merged[1:].copy()
+    changes = changes[~merged]
+    counts = np.diff(np.concatenate([[0], changes, [height * width]]))
+    if counts.shape[0] > 1 and counts[-1] == 0:
+        counts = counts[:-1]
+    counts = counts.tolist()
+    if compress:
+        counts = _rle_counts_to_string(counts)
+    return {"size": [int(height), int(width)], "counts": counts}
+
+
+def _rle_counts_to_string(counts):
+    """Compresses RLE counts to the COCO string format. Each count, after
+    the first 3, is stored as the difference to the count 2 places before
+    it, in 5 bit groups with a continuation bit, as ASCII characters.
+    """
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def _rle_counts_from_string(string):
+    """Reverses _rle_counts_to_string()."""
+    if isinstance(string, bytes):
+        string = string.decode("ascii")
+    counts = []
+    x = k = 0
+    for char in string:
+        c = ord(char) - 48
+        x |= (c & 0x1f) << 5 * k
+        k += 1
+        if c & 0x20:
+            continue
+        # Last group. Sign extend negative deltas.
+        if c & 0x10:
+            x |= -1 << 5 * k
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+        x = k = 0
+    return counts
+
+
+def rle_counts(rle):
+    """Returns the run lengths of an RLE dict as an int64 array, whether
+    its counts are a list or a compressed string.
+    """
+    counts = rle["counts"]
+    if isinstance(counts, (str, bytes)):
+        counts = _rle_counts_from_string(counts)
+    return np.asarray(counts, dtype=np.int64)
+
+
+def rle_decode(rle):
+    """Decodes an RLE dict to a binary mask.
+
+    Returns: [height, width] bool mask.
+    """
+    height, width = rle["size"]
+    counts = rle_counts(rle)
+    values = np.arange(counts.shape[0]) % 2 == 1
+    mask = np.repeat(values, counts)
+    return mask.reshape([width, height]).T
+
+
+def rle_encode_masks(masks, boxes=None, compress=False):
+    """Encodes a stack of binary masks.
+    masks: [height, width, N]
+    boxes: Optional. [N, (y1, x1, y2, x2)] boxes that contain each mask.
+        Makes encoding faster by only scanning the box crops.
+
+    Returns: list of N RLE dicts.
+    """
+    if boxes is None:
+        return [rle_encode(masks[:, :, i], compress=compress)
+                for i in range(masks.shape[-1])]
+    return [rle_encode(masks[y1:y2, x1:x2, i], (y1, x1, y2, x2), masks.shape,
+                       compress=compress)
+            for i, (y1, x1, y2, x2) in enumerate(boxes[:, :4])]
+
+
+def rle_decode_masks(rles, image_shape=None):
+    """Decodes a list of RLE dicts to a stack of binary masks.
+    image_shape: [height, width, ...]. Only needed if rles is empty.
+
+    Returns: [height, width, N] bool masks.
+    """
+    if not rles:
+        return np.zeros(tuple(image_shape[:2]) + (0,), dtype=bool)
+    masks = np.zeros(tuple(rles[0]["size"]) + (len(rles),), dtype=bool)
+    for i, rle in enumerate(rles):
+        masks[:, :, i] = rle_decode(rle)
+    return masks
+
+
+def _rle_runs(rle):
+    """Returns the [start, end) positions of the runs of 1s of an RLE in
+    column-major order.
+    """
+    ends = np.cumsum(rle_counts(rle))
+    starts = np.concatenate([[0], ends[:-1]])
+    return starts[1::2], ends[1::2]
+
+
+def rle_area(rle):
+    """Returns the number of 1s of an RLE mask."""
+    return int(rle_counts(rle)[1::2].sum())
+
+
+def rle_to_bbox(rle):
+    """Computes the bounding box of an RLE mask.
+
+    Returns: [y1, x1, y2, x2] int32 box, with (y2, x2) outside the box.
+        All zeros if the mask is empty, like extract_bboxes().
+    """
+    height = rle["size"][0]
+    starts, ends = _rle_runs(rle)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep] - 1
+    if starts.shape[0] == 0:
+        return np.zeros([4], dtype=np.int32)
+    x1 = starts // height
+    x2 = ends // height
+    # Runs that span columns cover the bottom of one column and the top of
+    # the next one.
+    spans = x2 > x1
+    y1 = np.where(spans, 0, starts % height)
+    y2 = np.where(spans, height - 1, ends % height)
+    return np.array([y1.min(), x1.min(), y2.max() + 1, x2.max() + 1],
+                    dtype=np.int32)
+
+
+def _rle_coverage(runs, positions):
+    """Counts the 1s before each of the given column-major positions.
+    runs: ([starts], [ends]) of the runs of 1s, as returned by _rle_runs().
+    """
+    starts, ends = runs
+    covered = np.concatenate([[0], np.cumsum(ends - starts)])
+    # Index of the last run starting at or before each position, plus 1
+    k = np.searchsorted(starts, positions, side="right")
+    last = np.maximum(k - 1, 0)
+    partial = np.clip(positions - starts[last], 0, ends[last] - starts[last])
+    return covered[last] + np.where(k > 0, partial, 0)
+
+
+def rle_iou(rles1, rles2):
+    """Computes IoU overlaps between two lists of RLE masks, without
+    decoding them. Pairs whose bounding boxes don't intersect are skipped.
+
+    Returns: [len(rles1), len(rles2)] float32 IoU overlaps. Same values as
+        compute_overlaps_masks() gives for the decoded masks.
+    """
+    runs1 = [_rle_runs(r) for r in rles1]
+    runs2 = [_rle_runs(r) for r in rles2]
+    area1 = np.array([(e - s).sum() for s, e in runs1], dtype=np.float32)
+    area2 = np.array([(e - s).sum() for s, e in runs2], dtype=np.float32)
+    boxes1 = np.array([rle_to_bbox(r) for r in rles1]).reshape([-1, 4])
+    boxes2 = np.array([rle_to_bbox(r) for r in rles2]).reshape([-1, 4])
+
+    intersections = np.zeros([len(rles1), len(rles2)], dtype=np.float32)
+    # Candidate pairs with intersecting boxes
+    y1 = np.maximum(boxes1[:, np.newaxis, 0], boxes2[np.newaxis, :, 0])
+    x1 = np.maximum(boxes1[:, np.newaxis, 1], boxes2[np.newaxis, :, 1])
+    y2 = np.minimum(boxes1[:, np.newaxis, 2], boxes2[np.newaxis, :, 2])
+    x2 = np.minimum(boxes1[:, np.newaxis, 3], boxes2[np.newaxis, :, 3])
+    for i, j in zip(*np.where((y2 > y1) & (x2 > x1))):
+        # The 1s of mask i before the ends of the runs of mask j, minus the
+        # ones before their starts, add up to the intersection.
+        starts, ends = runs2[j]
+        intersections[i, j] = (_rle_coverage(runs1[i], ends) -
+                               _rle_coverage(runs1[i], starts)).sum()
+
+    union = area1[:, np.newaxis] + area2[np.newaxis, :] - intersections
+    return intersections / union
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -687,6 +1241,105 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+class AnchorIndex(object):
+    """A spatial index over a static set of anchors. Used to find the anchors
+    that intersect a box without scoring every anchor in the pyramid.
+
+    Anchors are grouped by size. Within a group, the anchor centers lie on
+    a regular grid (see generate_anchors()), so the anchors that can
+    intersect a box are found with a binary search on the grid rows and
+    columns. The cost of a query scales with the area of the box rather
+    than with the number of anchors.
+
+    If anchors of the same size share a center, which custom anchor scales
+    can cause, the index can't be built and every anchor is scored, as in
+    compute_overlaps_argmax().
+
+    anchors: [N, (y1, x1, y2, x2)] Typically from generate_pyramid_anchors().
+    """
+
+    def __init__(self, anchors):
+        self.anchors = anchors
+        self.anchor_count = anchors.shape[0]
+        heights = anchors[:, 2] - anchors[:, 0]
+        widths = anchors[:, 3] - anchors[:, 1]
+        center_y = anchors[:, 0] + 0.5 * heights
+        center_x = anchors[:, 1] + 0.5 * widths
+
+        self.groups = []
+        sizes = np.stack([heights, widths], axis=1)
+        _, group_ids = np.unique(np.round(sizes, 3), axis=0, return_inverse=True)
+        for g in range(group_ids.max() + 1 if group_ids.size else 0):
+            ids = np.where(group_ids.ravel() == g)[0]
+            ys, row = np.unique(center_y[ids], return_inverse=True)
+            xs, col = np.unique(center_x[ids], return_inverse=True)
+            # [rows, cols] grid of anchor indices. -1 marks missing cells.
+            grid = np.full((ys.shape[0], xs.shape[0]), -1, dtype=np.int64)
+            grid[row.ravel(), col.ravel()] = ids
+            if np.count_nonzero(grid >= 0) != ids.shape[0]:
+                # Anchors of the same size with the same center. Fall back
+                # to scoring all anchors.
+                self.groups = None
+                return
+            # Half the largest anchor extent in the group, padded to absorb
+            # rounding in the center computation.
+            half_h = 0.5 * heights[ids].max() + 1e-3
+            half_w = 0.5 * widths[ids].max() + 1e-3
+            self.groups.append((ys, xs, grid, half_h, half_w))
+
+    def query(self, box):
+        """Returns the indices of the anchors that might intersect the
+        given [y1, x1, y2, x2] box. A superset of the anchors with IoU > 0.
+        """
+        if self.groups is None:
+            return np.arange(self.anchor_count)
+        y1, x1, y2, x2 = box[:4]
+        candidates = []
+        for ys, xs, grid, half_h, half_w in self.groups:
+            r1, r2 = np.searchsorted(ys, [y1 - half_h, y2 + half_h])
+            c1, c2 = np.searchsorted(xs, [x1 - half_w, x2 + half_w])
+            if r1 < r2 and c1 < c2:
+                candidates.append(grid[r1:r2, c1:c2].ravel())
+        if not candidates:
+            return np.zeros([0], dtype=np.int64)
+        candidates = np.concatenate(candidates)
+        return candidates[candidates >= 0]
+
+    def compute_overlaps_argmax(self, boxes):
+        """Same results as compute_overlaps_argmax(anchors, boxes), but only
+        the anchors that intersect a box are scored. Anchors that don't
+        intersect any box get an IoU of 0 and an argmax of 0, as with the
+        dense matrix.
+
+        boxes: [M, (y1, x1, y2, x2)]
+
+        Returns:
+        iou_max: [anchors] Max IoU of each anchor with any of the boxes.
+        iou_argmax: [anchors] Index of the box with the max IoU.
+        box_argmax: [M] Index of the anchor with the max IoU for each box.
+        """
+        if self.groups is None:
+            return compute_overlaps_argmax(self.anchors, boxes)
+        iou_max = np.zeros([self.anchor_count])
+        iou_argmax = np.zeros([self.anchor_count], dtype=np.int64)
+        box_argmax = np.zeros([boxes.shape[0]], dtype=np.int64)
+        for i in range(boxes.shape[0]):
+            ids = self.query(boxes[i])
+            a = self.anchors[ids]
+            a_area = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+            b_area = (boxes[i, 2] - boxes[i, 0]) * (boxes[i, 3] - boxes[i, 1])
+            iou = compute_iou(boxes[i], a, b_area, a_area)
+            # Boxes are visited in order, so only replacing on strictly
+            # larger values keeps the lowest box index on ties.
+            better = iou > iou_max[ids]
+            iou_max[ids[better]] = iou[better]
+            iou_argmax[ids[better]] = i
+            # Lowest anchor index with the max IoU
+            if iou.shape[0] and iou.max() > 0:
+                box_argmax[i] = ids[iou == iou.max()].min()
+        return iou_max, iou_argmax, box_argmax
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -701,65 +1354,171 @@ def trim_zeros(x):
     return x[~np.all(x == 0, axis=1)]
 
 
-def compute_matches(gt_boxes, gt_class_ids, gt_masks,
-                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
-                    iou_threshold=0.5, score_threshold=0.0):
-    """Finds matches between prediction and ground truth instances.
+def _match_at_thresholds(overlaps, pred_class_ids, gt_class_ids,
+                         iou_thresholds):
+    """Greedy matching of predictions to ground truth at several IoU
+    thresholds at once.
+    overlaps: [pred_count, gt_count] IoU overlaps, predictions sorted by
+        score from high to low.
+    pred_class_ids, gt_class_ids: 1-D arrays of class IDs.
+    iou_thresholds: 1-D array of IoU thresholds.
+
+    Each prediction is matched to the unmatched ground truth instance of
+    the same class with the highest IoU, if it reaches the threshold.
+    Predictions are walked once, and all thresholds are matched together.
 
     Returns:
-        gt_match: 1-D array. For each GT box it has the index of the matched
-                  predicted box.
-        pred_match: 1-D array. For each predicted box, it has the index of
-                    the matched ground truth box.
-        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+        gt_match: [thresholds, gt_count] index of the matched prediction,
+            or -1.
+        pred_match: [thresholds, pred_count] index of the matched ground
+            truth instance, or -1.
+    """
+    # Keep the thresholds in float64, as compute_matches() always compared
+    # them, so IoUs right at a threshold match the same way.
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    num_thresholds = iou_thresholds.shape[0]
+    gt_match = -1 * np.ones([num_thresholds, overlaps.shape[1]], dtype=np.int32)
+    pred_match = -1 * np.ones([num_thresholds, overlaps.shape[0]], dtype=np.int32)
+    if overlaps.shape[0] == 0 or overlaps.shape[1] == 0:
+        return gt_match, pred_match
+
+    # Ground truth of other classes can't be matched
+    ious = np.where(pred_class_ids[:, np.newaxis] == gt_class_ids[np.newaxis, :],
+                    overlaps, -1)
+    thresholds = iou_thresholds[:, np.newaxis]
+    rows = np.arange(num_thresholds)
+    # Only predictions that reach the lowest threshold can match anything
+    for i in np.where(np.any(ious >= iou_thresholds.min(), axis=1))[0]:
+        # Best unmatched ground truth at each threshold
+        candidates = np.where((gt_match < 0) & (ious[i] >= thresholds), ious[i], -1)
+        j = np.argmax(candidates, axis=1)
+        matched = candidates[rows, j] >= 0
+        pred_match[matched, i] = j[matched]
+        gt_match[rows[matched], j[matched]] = i
+    return gt_match, pred_match
+
+
+def _interpolated_ap(precisions, recalls):
+    """Area under the interpolated precision/recall curve, as specified by
+    the VOC paper.
+    precisions, recalls: [..., steps] values at each prediction step.
+
+    Returns:
+    ap: [...] AP values.
+    precisions: [..., steps + 2] interpolated precisions, padded with start
+        and end values.
+    recalls: [..., steps + 2] recalls, padded with start and end values.
+    """
+    # Pad with start and end values to simplify the math
+    shape = precisions.shape[:-1]
+    precisions = np.concatenate([np.zeros(shape + (1,)), precisions,
+                                 np.zeros(shape + (1,))], axis=-1)
+    recalls = np.concatenate([np.zeros(shape + (1,)), recalls,
+                              np.ones(shape + (1,))], axis=-1)
+
+    # Ensure precision values decrease but don't increase. This way, the
+    # precision value at each recall threshold is the maximum it can be
+    # for all following recall thresholds.
+    precisions = np.maximum.accumulate(precisions[..., ::-1], axis=-1)[..., ::-1]
+
+    # Sum over recall steps. Steps where recall doesn't change add zero.
+    ap = np.sum((recalls[..., 1:] - recalls[..., :-1]) * precisions[..., 1:],
+                axis=-1)
+    return ap, precisions, recalls
+
+
+def _sort_and_overlap(gt_boxes, gt_class_ids, gt_masks,
+                      pred_boxes, pred_class_ids, pred_scores, pred_masks):
+    """Trims zero padding, sorts predictions by score from high to low and
+    computes their mask IoU overlaps with the ground truth. If both masks
+    are None, box IoU overlaps are computed instead.
+
+    Returns: gt_class_ids, pred_class_ids, pred_scores and
+        [pred_boxes, gt_boxes] overlaps.
     """
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
-    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
     pred_boxes = trim_zeros(pred_boxes)
-    pred_scores = pred_scores[:pred_boxes.shape[0]]
+    gt_class_ids = np.asarray(gt_class_ids)[:gt_boxes.shape[0]]
+    pred_scores = np.asarray(pred_scores)[:pred_boxes.shape[0]]
     # Sort predictions by score from high to low
     indices = np.argsort(pred_scores)[::-1]
     pred_boxes = pred_boxes[indices]
-    pred_class_ids = pred_class_ids[indices]
+    pred_class_ids = np.asarray(pred_class_ids)[indices]
     pred_scores = pred_scores[indices]
-    pred_masks = pred_masks[..., indices]
+
+    if gt_masks is None and pred_masks is None:
+        return gt_class_ids, pred_class_ids, pred_scores, \
+            compute_overlaps(pred_boxes, gt_boxes)
+
+    if isinstance(gt_masks, list):
+        gt_masks = gt_masks[:gt_boxes.shape[0]]
+    else:
+        gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    if isinstance(pred_masks, list):
+        pred_masks = [pred_masks[i] for i in indices]
+    else:
+        pred_masks = pred_masks[..., indices]
 
     # Compute IoU overlaps [pred_masks, gt_masks]
     overlaps = compute_overlaps_masks(pred_masks, gt_masks)
+    return gt_class_ids, pred_class_ids, pred_scores, overlaps
+
+
+def compute_matches_range(gt_boxes, gt_class_ids, gt_masks,
+                          pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                          iou_thresholds=None, score_threshold=0.0):
+    """Finds matches between prediction and ground truth instances at
+    several IoU thresholds. The overlaps are computed once and all the
+    thresholds are matched in one pass over the predictions.
+    gt_masks, pred_masks: [height, width, instances] binary masks, or lists
+        of RLE dicts. See rle_encode().
+    iou_thresholds: 1-D array of IoU thresholds. Default is 0.5 to 0.95
+        with increments of 0.05.
+    score_threshold: Ground truth instances with a lower IoU than this are
+        never matched.
 
-    # Loop through predictions and find matching ground truth boxes
-    match_count = 0
-    pred_match = -1 * np.ones([pred_boxes.shape[0]])
-    gt_match = -1 * np.ones([gt_boxes.shape[0]])
-    for i in range(len(pred_boxes)):
-        # Find best matching ground truth box
-        # 1. Sort matches by score
-        sorted_ixs = np.argsort(overlaps[i])[::-1]
-        # 2. Remove low scores
-        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
-        if low_score_idx.size > 0:
-            sorted_ixs = sorted_ixs[:low_score_idx[0]]
-        # 3. Find the match
-        for j in sorted_ixs:
-            # If ground truth box is already matched, go to next one
-            if gt_match[j] > 0:
-                continue
-            # If we reach IoU smaller than the threshold, end the loop
-            iou = overlaps[i, j]
-            if iou < iou_threshold:
-                break
-            # Do we have a match?
-            if pred_class_ids[i] == gt_class_ids[j]:
-                match_count += 1
-                gt_match[j] = i
-                pred_match[i] = j
-                break
-
+    Returns:
+        gt_match: [thresholds, gt_boxes]. For each GT box it has the index
+                  of the matched predicted box, or -1.
+        pred_match: [thresholds, pred_boxes]. For each predicted box, it has
+                    the index of the matched ground truth box, or -1.
+        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    Predictions are sorted by score from high to low.
+    """
+    if iou_thresholds is None:
+        iou_thresholds = np.arange(0.5, 1.0, 0.05)
+    gt_class_ids, pred_class_ids, _, overlaps = _sort_and_overlap(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks)
+    gt_match, pred_match = _match_at_thresholds(
+        overlaps, pred_class_ids, gt_class_ids,
+        np.maximum(iou_thresholds, score_threshold))
     return gt_match, pred_match, overlaps
 
 
+def compute_matches(gt_boxes, gt_class_ids, gt_masks,
+                    pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                    iou_threshold=0.5, score_threshold=0.0):
+    """Finds matches between prediction and ground truth instances.
+    gt_masks, pred_masks: [height, width, instances] binary masks, or lists
+        of RLE dicts. See rle_encode().
+
+    Returns:
+        gt_match: 1-D array. For each GT box it has the index of the matched
+                  predicted box.
+        pred_match: 1-D array. For each predicted box, it has the index of
+                    the matched ground truth box.
+        overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    """
+    gt_match, pred_match, overlaps = compute_matches_range(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks,
+        [iou_threshold], score_threshold)
+    return gt_match[0], pred_match[0], overlaps
+
+
 def compute_ap(gt_boxes, gt_class_ids, gt_masks,
                pred_boxes, pred_class_ids, pred_scores, pred_masks,
                iou_threshold=0.5):
@@ -771,32 +1530,40 @@ def compute_ap(gt_boxes, gt_class_ids, gt_masks,
     recalls: List of recall values at different class score thresholds.
     overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
-    # Get matches and overlaps
-    gt_match, pred_match, overlaps = compute_matches(
+    APs, precisions, recalls, overlaps = compute_ap_thresholds(
         gt_boxes, gt_class_ids, gt_masks,
         pred_boxes, pred_class_ids, pred_scores, pred_masks,
-        iou_threshold)
+        [iou_threshold])
+    return APs[0], precisions[0], recalls[0], overlaps
 
-    # Compute precision and recall at each prediction box step
-    precisions = np.cumsum(pred_match > -1) / (np.arange(len(pred_match)) + 1)
-    recalls = np.cumsum(pred_match > -1).astype(np.float32) / len(gt_match)
 
-    # Pad with start and end values to simplify the math
-    precisions = np.concatenate([[0], precisions, [0]])
-    recalls = np.concatenate([[0], recalls, [1]])
+def compute_ap_thresholds(gt_boxes, gt_class_ids, gt_masks,
+                          pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                          iou_thresholds=None):
+    """Compute Average Precision at several IoU thresholds at once. Default
+    is 0.5 to 0.95 with increments of 0.05.
 
-    # Ensure precision values decrease but don't increase. This way, the
-    # precision value at each recall threshold is the maximum it can be
-    # for all following recall thresholds, as specified by the VOC paper.
-    for i in range(len(precisions) - 2, -1, -1):
-        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    Returns:
+    APs: [thresholds] Average Precision at each threshold.
+    precisions: [thresholds, steps] precisions at different class score
+        thresholds.
+    recalls: [thresholds, steps] recall values at different class score
+        thresholds.
+    overlaps: [pred_boxes, gt_boxes] IoU overlaps.
+    """
+    # Get matches and overlaps
+    gt_match, pred_match, overlaps = compute_matches_range(
+        gt_boxes, gt_class_ids, gt_masks,
+        pred_boxes, pred_class_ids, pred_scores, pred_masks,
+        iou_thresholds)
 
-    # Compute mean AP over recall range
-    indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
-    mAP = np.sum((recalls[indices] - recalls[indices - 1]) *
-                 precisions[indices])
+    # Compute precision and recall at each prediction box step
+    true_positives = np.cumsum(pred_match > -1, axis=1)
+    precisions = true_positives / (np.arange(pred_match.shape[1]) + 1)
+    recalls = true_positives.astype(np.float32) / gt_match.shape[1]
 
-    return mAP, precisions, recalls, overlaps
+    APs, precisions, recalls = _interpolated_ap(precisions, recalls)
+    return APs, precisions, recalls, overlaps
 
 
 def compute_ap_range(gt_box, gt_class_id, gt_mask,
@@ -804,19 +1571,18 @@ def compute_ap_range(gt_box, gt_class_id, gt_mask,
                      iou_thresholds=None, verbose=1):
     """Compute AP over a range or IoU thresholds. Default range is 0.5-0.95."""
     # Default is 0.5 to 0.95 with increments of 0.05
-    iou_thresholds = iou_thresholds or np.arange(0.5, 1.0, 0.05)
-    
+    if iou_thresholds is None:
+        iou_thresholds = np.arange(0.5, 1.0, 0.05)
+
     # Compute AP over range of IoU thresholds
-    AP = []
-    for iou_threshold in iou_thresholds:
-        ap, precisions, recalls, overlaps =\
-            compute_ap(gt_box, gt_class_id, gt_mask,
-                        pred_box, pred_class_id, pred_score, pred_mask,
-                        iou_threshold=iou_threshold)
-        if verbose:
+    AP, _, _, _ = compute_ap_thresholds(
+        gt_box, gt_class_id, gt_mask,
+        pred_box, pred_class_id, pred_score, pred_mask,
+        iou_thresholds)
+    if verbose:
+        for iou_threshold, ap in zip(iou_thresholds, AP):
             print("AP @{:.2f}:\t {:.3f}".format(iou_threshold, ap))
-        AP.append(ap)
-    AP = np.array(AP).mean()
+    AP = AP.mean()
     if verbose:
         print("AP @{:.2f}-{:.2f}:\t {:.3f}".format(
             iou_thresholds[0], iou_thresholds[-1], AP))
@@ -841,6 +1607,129 @@ def compute_recall(pred_boxes, gt_boxes, iou):
     return recall, positive_ids
 
 
+class APEvaluator(object):
+    """Accumulates matches over a dataset and computes dataset-level AP and
+    AR per class, rather than averaging per-image AP.
+
+    Detections are added one image at a time with add(). Mask overlaps are
+    computed once per image and matched at all IoU thresholds together.
+    Only the score and the per-threshold match flags of each detection are
+    kept, so memory doesn't grow with image or mask size. add() can be
+    called from several threads.
+
+    evaluator = APEvaluator()
+    for image_id in dataset.image_ids:
+        ...
+        evaluator.add(gt_bbox, gt_class_id, gt_mask,
+                      r['rois'], r['class_ids'], r['scores'], r['masks'])
+    results = evaluator.evaluate()
+
+    iou_thresholds: IoU thresholds to match at. Default is 0.5 to 0.95
+        with increments of 0.05.
+    """
+
+    def __init__(self, iou_thresholds=None):
+        if iou_thresholds is None:
+            iou_thresholds = np.arange(0.5, 1.0, 0.05)
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drops all accumulated matches."""
+        self.image_count = 0
+        self._scores = []
+        self._class_ids = []
+        self._matches = []
+        self._gt_counts = {}
+
+    def add(self, gt_boxes, gt_class_ids, gt_masks,
+            pred_boxes, pred_class_ids, pred_scores, pred_masks):
+        """Matches the detections of one image and accumulates the results.
+        gt_boxes, pred_boxes: [N, (y1, x1, y2, x2)] in image coordinates.
+            Zero padding is trimmed.
+        gt_class_ids, pred_class_ids: [N] int class IDs.
+        pred_scores: [N] float confidence scores.
+        gt_masks, pred_masks: [height, width, N] binary masks, or lists of
+            RLE dicts. See rle_encode(). If both are None, instances are
+            matched on box IoU instead.
+
+        Returns:
+            gt_match, pred_match, overlaps: as in compute_matches(), with
+                the matches for each IoU threshold stacked in the first
+                dimension. Predictions are sorted by score.
+        """
+        gt_class_ids, pred_class_ids, pred_scores, overlaps = _sort_and_overlap(
+            gt_boxes, gt_class_ids, gt_masks,
+            pred_boxes, pred_class_ids, pred_scores, pred_masks)
+        gt_match, pred_match = _match_at_thresholds(
+            overlaps, pred_class_ids, gt_class_ids, self.iou_thresholds)
+
+        with self._lock:
+            self.image_count += 1
+            self._scores.append(pred_scores.astype(np.float32))
+            self._class_ids.append(pred_class_ids.astype(np.int32))
+            self._matches.append((pred_match > -1).T)
+            for class_id, count in zip(*np.unique(gt_class_ids, return_counts=True)):
+                self._gt_counts[class_id] = self._gt_counts.get(class_id, 0) + count
+        return gt_match, pred_match, overlaps
+
+    def evaluate(self, verbose=0):
+        """Computes AP and AR from the detections added so far. Classes
+        without ground truth instances are left out.
+
+        Returns a dict:
+            class_ids: [classes] class IDs with ground truth instances.
+            class_ap: [classes, thresholds] AP of each class.
+            class_ar: [classes, thresholds] recall of each class at the
+                lowest score.
+            ap: [thresholds] AP averaged over classes.
+            ar: [thresholds] AR averaged over classes.
+            mAP: AP averaged over classes and thresholds.
+            mAR: AR averaged over classes and thresholds.
+        """
+        num_thresholds = self.iou_thresholds.shape[0]
+        class_ids = np.array(sorted(c for c, n in self._gt_counts.items() if n > 0),
+                             dtype=np.int32)
+        class_ap = np.zeros([len(class_ids), num_thresholds])
+        class_ar = np.zeros([len(class_ids), num_thresholds])
+        if self._scores:
+            scores = np.concatenate(self._scores)
+            pred_class_ids = np.concatenate(self._class_ids)
+            matches = np.concatenate(self._matches)
+            # Group detections by class, highest score first
+            order = np.lexsort((-scores, pred_class_ids))
+            pred_class_ids = pred_class_ids[order]
+            matches = matches[order]
+            starts = np.searchsorted(pred_class_ids, class_ids, side="left")
+            ends = np.searchsorted(pred_class_ids, class_ids, side="right")
+            for i, class_id in enumerate(class_ids):
+                if ends[i] == starts[i]:
+                    continue
+                true_positives = np.cumsum(matches[starts[i]:ends[i]], axis=0).T
+                precisions = true_positives / np.arange(1, ends[i] - starts[i] + 1)
+                recalls = true_positives / self._gt_counts[class_id]
+                class_ap[i] = _interpolated_ap(precisions, recalls)[0]
+                class_ar[i] = recalls[:, -1]
+
+        results = {
+            "class_ids": class_ids,
+            "class_ap": class_ap,
+            "class_ar": class_ar,
+            "ap": class_ap.mean(axis=0) if class_ids.size else np.zeros(num_thresholds),
+            "ar": class_ar.mean(axis=0) if class_ids.size else np.zeros(num_thresholds),
+        }
+        results["mAP"] = results["ap"].mean()
+        results["mAR"] = results["ar"].mean()
+        if verbose:
+            for t, ap, ar in zip(self.iou_thresholds, results["ap"], results["ar"]):
+                print("AP @{:.2f}:\t {:.3f}\tAR: {:.3f}".format(t, ap, ar))
+            print("AP @{:.2f}-{:.2f}:\t {:.3f}\tAR: {:.3f}".format(
+                self.iou_thresholds[0], self.iou_thresholds[-1],
+                results["mAP"], results["mAR"]))
+        return results
+
+
 # ## Batch Slicing
 # Some custom layers support a batch size of 1 only, and require a lot of work
 # to support batches greater than 1. This function slices an input tensor
@@ -0,0 +1,292 @@
+import os
+import random
+import concurrent.futures
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from mrcnn import model as modellib  # noqa: E402
+from mrcnn import utils  # noqa: E402
+from mrcnn.config import Config  # noqa: E402
+
+
+class _TestConfig(Config):
+    NAME = "test"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 2
+    NUM_CLASSES = 3
+    IMAGE_MIN_DIM = 64
+    IMAGE_MAX_DIM = 128
+    RPN_ANCHOR_SCALES = (8, 16, 32, 64, 128)
+    RPN_TRAIN_ANCHORS_PER_IMAGE = 64
+    MINI_MASK_SHAPE = (14, 14)
+    TRAIN_ROIS_PER_IMAGE = 32
+    MAX_GT_INSTANCES = 5
+
+
+class _InMemoryDataset(utils.Dataset):
+    """Random images with 1 to 4 rectangular instances. Images are kept in
+    the image info, as arrays, rather than loaded from files.
+    """
+
+    def load_shapes(self, count, seed=0):
+        self.add_class("shapes", 1, "square")
+        self.add_class("shapes", 2, "box")
+        rng = np.random.RandomState(seed)
+        sizes = [(64, 96), (48, 64), (96, 128), (160, 96), (64, 64)]
+        for i in range(count):
+            h, w = sizes[i % len(sizes)]
+            boxes = []
+            for _ in range(rng.randint(1, 5)):
+                y1, x1 = rng.randint(0, h - 16), rng.randint(0, w - 16)
+                boxes.append([y1, x1, rng.randint(y1 + 8, h + 1),
+                              rng.randint(x1 + 8, w + 1)])
+            self.add_image("shapes", i, None, height=h, width=w,
+                           pixels=rng.randint(0, 256, (h, w, 3)).astype(np.uint8),
+                           boxes=np.array(boxes),
+                           class_ids=rng.randint(1, 3, len(boxes)).astype(np.int32))
+
+    def load_image(self, image_id):
+        return self.image_info[image_id]["pixels"]
+
+    def load_mask(self, image_id):
+        info = self.image_info[image_id]
+        mask = np.zeros([info["height"], info["width"], len(info["boxes"])], dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(info["boxes"]):
+            mask[y1:y2, x1:x2, i] = True
+        return mask, info["class_ids"]
+
+
+def _dataset(count, seed=0):
+    dataset = _InMemoryDataset()
+    dataset.load_shapes(count, seed)
+    dataset.prepare()
+    return dataset
+
+
+def _top_k_roi_align(boxes, image_meta, feature_maps, pool_shape):
+    """PyramidROIAlign with the original top_k reordering of the pooled
+    boxes. Used as the reference for the invert_permutation reorder."""
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=2)
+    h = y2 - y1
+    w = x2 - x1
+    image_shape = modellib.parse_image_meta_graph(image_meta)['image_shape']
+    image_area = tf.reshape(
+        tf.cast(image_shape[:, 0] * image_shape[:, 1], tf.float32), [-1, 1, 1])
+    roi_level = modellib.log2_graph(tf.sqrt(h * w) / (224.0 / tf.sqrt(image_area)))
+    roi_level = tf.minimum(5, tf.maximum(
+        2, 4 + tf.cast(tf.round(roi_level), tf.int32)))
+    roi_level = tf.squeeze(roi_level, 2)
+
+    pooled = []
+    box_to_level = []
+    for i, level in enumerate(range(2, 6)):
+        ix = tf.where(tf.equal(roi_level, level))
+        level_boxes = tf.gather_nd(boxes, ix)
+        box_indices = tf.cast(ix[:, 0], tf.int32)
+        box_to_level.append(ix)
+        pooled.append(tf.image.crop_and_resize(
+            feature_maps[i], level_boxes, box_indices, pool_shape,
+            method="bilinear"))
+    pooled = tf.concat(pooled, axis=0)
+
+    box_to_level = tf.concat(box_to_level, axis=0)
+    box_range = tf.expand_dims(tf.range(tf.shape(box_to_level)[0]), 1)
+    box_to_level = tf.concat([tf.cast(box_to_level, tf.int32), box_range],
+                             axis=1)
+    sorting_tensor = box_to_level[:, 0] * 100000 + box_to_level[:, 1]
+    ix = tf.nn.top_k(sorting_tensor, k=tf.shape(
+        box_to_level)[0]).indices[::-1]
+    ix = tf.gather(box_to_level[:, 2], ix)
+    pooled = tf.gather(pooled, ix)
+    shape = tf.concat([tf.shape(boxes)[:2], tf.shape(pooled)[1:]], axis=0)
+    return tf.reshape(pooled, shape)
+
+
+def test_pyramid_roi_align_matches_top_k_reorder():
+    rng = np.random.RandomState(0)
+    batch, count, size, channels = 2, 48, 256, 8
+
+    # Boxes from 4 to 256 pixels on a side, so every pyramid level gets
+    # some, followed by zero padding.
+    side = np.exp(rng.uniform(np.log(4), np.log(size), (batch, count, 2)))
+    y1x1 = rng.uniform(0, size - side)
+    boxes = np.concatenate([y1x1, y1x1 + side], axis=2) / size
+    boxes[:, -6:] = 0
+    boxes = boxes.astype(np.float32)
+
+    feature_maps = [rng.rand(batch, size // s, size // s, channels)
+                    .astype(np.float32) for s in [4, 8, 16, 32]]
+    image_meta = np.stack([modellib.compose_image_meta(
+        i, (size, size, 3), (size, size, 3), (0, 0, size, size), 1,
+        np.zeros([2], np.int32)) for i in range(batch)]).astype(np.float32)
+
+    inputs = [tf.constant(boxes), tf.constant(image_meta)] + \
+        [tf.constant(f) for f in feature_maps]
+    single = modellib.PyramidROIAlign([7, 7]).call(inputs)
+    multi = modellib.PyramidROIAlign([[7, 7], [14, 14]]).call(inputs)
+    expected = [_top_k_roi_align(inputs[0], inputs[1], inputs[2:], shape)
+                for shape in [[7, 7], [14, 14]]]
+    with tf.Session() as sess:
+        single, multi, expected = sess.run([single, multi, expected])
+
+    assert single.shape == (batch, count, 7, 7, channels)
+    np.testing.assert_array_equal(single, expected[0])
+    np.testing.assert_array_equal(multi[0], expected[0])
+    np.testing.assert_array_equal(multi[1], expected[1])
+
+
+def test_sample_cache_matches_load_image_gt(tmpdir):
+    config = _TestConfig()
+    dataset = _dataset(7)
+    cache = modellib.SampleCache(str(tmpdir), dataset, config, shard_size=3)
+    cache.build(verbose=0)
+    meta_dtypes = set()
+    for image_id in dataset.image_ids:
+        expected = modellib.load_image_gt(dataset, config, image_id,
+                                          use_mini_mask=config.USE_MINI_MASK)
+        for actual, e in zip(cache.load(image_id), expected):
+            assert actual.dtype == e.dtype
+            np.testing.assert_array_equal(actual, e)
+        meta_dtypes.add(expected[1].dtype)
+    # Unscaled images have an integer image meta, scaled ones a float one
+    assert len(meta_dtypes) == 2
+
+    # Editing an image array in the middle, where repr() elides it, changes
+    # the key so that the stale samples aren't served
+    key = cache.key
+    dataset.image_info[2]["pixels"][48, 64] += 1
+    assert modellib.SampleCache(str(tmpdir), dataset, config).key != key
+
+
+def test_sample_cache_key_rpn_fields():
+    dataset = _dataset(2)
+    config = _TestConfig()
+    key = modellib.SampleCache.compute_key(dataset, config, rpn_targets=True)
+
+    # A different anchor grid invalidates the cached RPN candidates
+    def backbone_shapes(image_shape):
+        return np.array([[image_shape[0] // s, image_shape[1] // s]
+                         for s in config.BACKBONE_STRIDES])
+    config.COMPUTE_BACKBONE_SHAPE = backbone_shapes
+    assert modellib.SampleCache.compute_key(
+        dataset, config, rpn_targets=True) != key
+    # But not the cached samples, which don't depend on the anchors
+    assert modellib.SampleCache.compute_key(dataset, config) == \
+        modellib.SampleCache.compute_key(dataset, _TestConfig())
+
+
+def _assert_batches_equal(batch1, batch2):
+    for arrays1, arrays2 in zip(batch1, batch2):
+        assert len(arrays1) == len(arrays2)
+        for a1, a2 in zip(arrays1, arrays2):
+            assert a1.dtype == a2.dtype
+            np.testing.assert_array_equal(a1, a2)
+
+
+def _get_batch(sequence, epoch, idx):
+    sequence.set_epoch(epoch)
+    return sequence.get_batch(idx)
+
+
+def test_data_sequence_batches_are_reproducible():
+    config = _TestConfig()
+    sequence = modellib.DataSequence(
+        _dataset(9), config, shuffle=True, augment=True, random_rois=16,
+        batch_size=config.BATCH_SIZE, seed=3)
+    np.random.seed(0)
+    random.seed(0)
+    np_state = np.random.get_state()[1].copy()
+    py_state = random.getstate()
+
+    expected = _get_batch(sequence, 1, 2)
+    # The global generators are left alone
+    np.testing.assert_array_equal(np.random.get_state()[1], np_state)
+    assert random.getstate() == py_state
+
+    # Same batch after other batches, and in a thread and a process
+    for i in range(len(sequence)):
+        _get_batch(sequence, 2, i)
+    _assert_batches_equal(_get_batch(sequence, 1, 2), expected)
+    for executor in [concurrent.futures.ThreadPoolExecutor(1),
+                     concurrent.futures.ProcessPoolExecutor(1)]:
+        with executor:
+            _assert_batches_equal(
+                executor.submit(_get_batch, sequence, 1, 2).result(), expected)
+
+    # Other epochs shuffle differently
+    orders = [_get_batch(sequence, e, 0)[0][1][:, 0] for e in range(4)]
+    assert len(set(tuple(o) for o in orders)) > 1
+
+
+class _FailingDataset(_InMemoryDataset):
+    """Fails to load images once the file at fail_path exists."""
+    fail_path = None
+
+    def load_image(self, image_id):
+        if os.path.exists(self.fail_path):
+            raise IOError("Can't read image {}".format(image_id))
+        return super(_FailingDataset, self).load_image(image_id)
+
+
+def test_shared_memory_loader_matches_get_batch(tmpdir):
+    pytest.importorskip("multiprocessing.shared_memory")
+    config = _TestConfig()
+    dataset = _FailingDataset()
+    dataset.fail_path = str(tmpdir.join("fail"))
+    dataset.load_shapes(7)
+    dataset.prepare()
+
+    def sequence():
+        return modellib.DataSequence(dataset, config, shuffle=True,
+                                     augment=True, random_rois=8,
+                                     batch_size=config.BATCH_SIZE, seed=5)
+    reference = sequence()
+    loader = modellib.SharedMemoryLoader(sequence(), workers=2, slots=3)
+    try:
+        # Two epochs and a bit, so slots are reused and the epoch rolls over
+        for step in range(2 * len(reference) + 2):
+            epoch, idx = divmod(step, len(reference))
+            batch = next(loader)
+            _assert_batches_equal(batch, _get_batch(reference, epoch, idx))
+
+        # Errors in the workers are raised in the trainer. The slots that
+        # are already filled are served first.
+        open(dataset.fail_path, "w").close()
+        with pytest.raises(Exception, match="Error in data worker"):
+            for _ in range(5):
+                next(loader)
+    finally:
+        loader.close()
+
+
+def test_data_sequence_pad64_batch():
+    class PadConfig(_TestConfig):
+        IMAGE_RESIZE_MODE = "pad64_batch"
+    config = PadConfig()
+    dataset = _dataset(9)
+    sequence = modellib.DataSequence(dataset, config, shuffle=True,
+                                     batch_size=config.BATCH_SIZE, seed=7)
+    image_ids = []
+    shapes = set()
+    for idx in range(len(sequence)):
+        inputs, _ = sequence.get_batch(idx)
+        images, image_meta, rpn_match = inputs[:3]
+        shape = images.shape[1:3]
+        shapes.add(shape)
+        # Padded to multiples of 64, at most IMAGE_SHAPE, and big enough
+        # for the windows of all images
+        assert shape[0] % 64 == 0 and shape[1] % 64 == 0
+        assert np.all(np.array(shape) <= config.IMAGE_SHAPE[:2])
+        windows = modellib.parse_image_meta(image_meta)["window"]
+        assert np.all(windows[:, 2:] <= shape)
+        np.testing.assert_array_equal(image_meta[:, 4:6], [shape] * len(images))
+        # Anchors and RPN targets of the batch shape
+        anchors = modellib.pyramid_anchors(config, shape, normalized=True)
+        np.testing.assert_array_equal(inputs[-1], [anchors] * len(images))
+        assert rpn_match.shape[1] == anchors.shape[0]
+        image_ids.extend(image_meta[:, 0].astype(int))
+    # Every image is used, and some batches are padded less than IMAGE_SHAPE
+    assert set(image_ids) == set(dataset.image_ids)
+    assert len(shapes) > 1
@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+import skimage.transform
+
+pytest.importorskip("tensorflow")
+from mrcnn import utils  # noqa: E402
+
+
+def test_ap_range_iou_at_threshold():
+    # IoU of 0.7 in float32 is just below the 0.7 of np.arange(0.5, 1.0, 0.05)
+    gt_boxes = np.array([[0, 0, 10, 10]])
+    pred_boxes = np.array([[0, 0, 10, 7]])
+    class_ids = np.array([1])
+    scores = np.array([0.9])
+    thresholds = np.arange(0.5, 1.0, 0.05)
+    assert thresholds[4] > 0.7
+
+    aps = utils.compute_ap_thresholds(gt_boxes, class_ids, None,
+                                      pred_boxes, class_ids, scores, None,
+                                      iou_thresholds=thresholds)[0]
+    np.testing.assert_array_equal(aps, [1, 1, 1, 1, 0, 0, 0, 0, 0, 0])
+    # Same as matching at one threshold at a time
+    for t, ap in zip(thresholds, aps):
+        assert utils.compute_ap(gt_boxes, class_ids, None, pred_boxes,
+                                class_ids, scores, None, iou_threshold=t)[0] == ap
+
+    evaluator = utils.APEvaluator(iou_thresholds=thresholds)
+    evaluator.add(gt_boxes, class_ids, None, pred_boxes, class_ids, scores, None)
+    assert evaluator.evaluate(verbose=0)["ap"][4] == 0
+
+
+def _random_boxes(rng, count, size=256):
+    y1x1 = rng.randint(0, size - 20, (count, 2))
+    hw = rng.randint(4, 80, (count, 2))
+    return np.concatenate([y1x1, np.minimum(y1x1 + hw, size)], axis=1)
+
+
+def _random_masks(rng, count, shape=(64, 48)):
+    masks = np.zeros(shape + (count,), dtype=bool)
+    for i, (y1, x1, y2, x2) in enumerate(_random_boxes(rng, count, min(shape))):
+        masks[y1:y2, x1:x2, i] = rng.rand(y2 - y1, x2 - x1) > 0.3
+    return masks
+
+
+def test_anchor_index_matches_compute_overlaps():
+    rng = np.random.RandomState(0)
+    shapes = np.array([[64, 64], [32, 32], [16, 16], [8, 8], [4, 4]])
+    boxes = _random_boxes(rng, 20)
+    # The second set repeats a scale on levels with shared centers, so the
+    # index falls back to scoring all anchors.
+    for scales in [(16, 32, 64, 128, 256), (16, 16, 64, 128, 256)]:
+        anchors = utils.generate_pyramid_anchors(
+            scales, [0.5, 1, 2], shapes, [4, 8, 16, 32, 64], 1)
+        index = utils.AnchorIndex(anchors)
+        assert (index.groups is None) == (scales[0] == scales[1])
+
+        expected = utils.compute_overlaps_argmax(anchors, boxes)
+        for actual, e in zip(index.compute_overlaps_argmax(boxes), expected):
+            np.testing.assert_array_equal(actual, e)
+        overlaps = utils.compute_overlaps(anchors, boxes)
+        np.testing.assert_allclose(expected[0], overlaps.max(axis=1), rtol=1e-6)
+
+
+def _greedy_nms(boxes, scores, threshold):
+    """Reference NMS: one box at a time against all the remaining ones."""
+    ixs = scores.argsort()[::-1]
+    pick = []
+    while len(ixs):
+        pick.append(ixs[0])
+        iou = utils.compute_overlaps(boxes[ixs[:1]], boxes[ixs[1:]])[0]
+        ixs = ixs[1:][iou <= threshold]
+    return np.array(pick)
+
+
+def test_non_max_suppression():
+    rng = np.random.RandomState(1)
+    boxes = _random_boxes(rng, 300)
+    scores = rng.rand(300)
+    class_ids = rng.randint(1, 4, 300)
+
+    keep = utils.non_max_suppression(boxes, scores, 0.3, tile_size=32)
+    np.testing.assert_array_equal(keep, _greedy_nms(boxes, scores, 0.3))
+    # max_output stops early with the same leading picks
+    np.testing.assert_array_equal(
+        utils.non_max_suppression(boxes, scores, 0.3, max_output=10), keep[:10])
+    # class_ids runs the NMS of each class in one call
+    expected = np.concatenate([
+        np.where(class_ids == c)[0][_greedy_nms(boxes[class_ids == c],
+                                                scores[class_ids == c], 0.3)]
+        for c in range(1, 4)])
+    expected = expected[np.argsort(-scores[expected])]
+    np.testing.assert_array_equal(
+        utils.non_max_suppression(boxes, scores, 0.3, class_ids=class_ids),
+        expected)
+
+
+def test_rle_roundtrip():
+    rng = np.random.RandomState(2)
+    masks = _random_masks(rng, 6)
+    masks[:, :, 0] = False
+    masks[:, :, 1] = True
+    boxes = utils.extract_bboxes(masks)
+
+    for compress in [False, True]:
+        rles = utils.rle_encode_masks(masks, compress=compress)
+        np.testing.assert_array_equal(utils.rle_decode_masks(rles), masks)
+        # Encoding the box crops gives the same RLEs
+        assert utils.rle_encode_masks(masks, boxes, compress=compress) == rles
+    assert [utils.rle_area(r) for r in rles] == masks.sum(axis=(0, 1)).tolist()
+    np.testing.assert_array_equal([utils.rle_to_bbox(r) for r in rles], boxes)
+    np.testing.assert_allclose(
+        utils.rle_iou(rles, rles[::-1]),
+        utils.compute_overlaps_masks(masks, masks[:, :, ::-1]), rtol=1e-6)
+
+
+def test_compute_overlaps_masks_mixed_inputs():
+    rng = np.random.RandomState(4)
+    masks1 = _random_masks(rng, 5)
+    masks2 = _random_masks(rng, 3).astype(np.float32)
+    masks2[:, :, 2] = 0
+    rles1 = utils.rle_encode_masks(masks1)
+    rles2 = utils.rle_encode_masks(masks2 > .5, compress=True)
+    expected = utils.compute_overlaps_masks(masks1, masks2)
+
+    # A dense stack on either side is encoded before comparing
+    np.testing.assert_allclose(
+        utils.compute_overlaps_masks(masks1, rles2), expected, rtol=1e-6)
+    np.testing.assert_allclose(
+        utils.compute_overlaps_masks(rles1, masks2), expected, rtol=1e-6)
+    assert utils.compute_overlaps_masks(masks1[:, :, :0], rles2).shape == (0, 3)
+
+
+def test_mini_mask_roundtrip():
+    rng = np.random.RandomState(3)
+    masks = _random_masks(rng, 8)
+    masks[:, :, 0] = False
+    masks[10:40, 5:30, 0] = True
+    masks = masks[:, :, masks.any(axis=(0, 1))]
+    boxes = utils.extract_bboxes(masks)
+
+    mini = utils.minimize_mask(boxes, masks, (28, 28))
+    assert mini.shape == (28, 28, masks.shape[-1]) and mini.dtype == bool
+    # Same as resizing each box crop with skimage
+    for i, (y1, x1, y2, x2) in enumerate(boxes):
+        expected = skimage.transform.resize(
+            masks[y1:y2, x1:x2, i].astype(float), (28, 28), order=1,
+            mode="constant", preserve_range=True, anti_aliasing=False)
+        np.testing.assert_array_equal(mini[:, :, i], np.around(expected))
+
+    # Expanding restores the boxes, and a filled box exactly
+    expanded = utils.expand_mask(boxes, mini, masks.shape)
+    assert expanded.shape == masks.shape
+    np.testing.assert_array_equal(utils.extract_bboxes(expanded)[0], boxes[0])
+    np.testing.assert_array_equal(expanded[:, :, 0], masks[:, :, 0])